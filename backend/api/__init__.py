@@ -1 +1,2 @@
-from .fragment import AsyncFragmentAPIClient
\ No newline at end of file
+from .fragment import AsyncFragmentAPIClient, FragmentAPIError, FragmentCircuitOpenError, FRAGMENT_API_URL, FRAGMENT_TIMEOUT, extract_orders, order_amount, order_id, order_recipient, parse_order_time
+from .resilience import CircuitBreaker, RetryPolicy
\ No newline at end of file
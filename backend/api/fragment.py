@@ -1,9 +1,14 @@
-import aiohttp
 import asyncio
 import base64
+import httpx
 import logging
-from typing import Optional, Dict, Any
+import os
+import time
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
 from dataclasses import dataclass
+from datetime import datetime
+
+from .resilience import CircuitBreaker, EndpointStats, RetryPolicy
 
 logger = logging.getLogger(__name__)
 
@@ -44,101 +49,217 @@ class GetOrdersRequest:
 class FragmentAPIError(Exception):
     """Raised when the Fragment API returns an error response."""
 
-    def __init__(self, message):
+    def __init__(self, message, status_code: Optional[int] = None):
         self.message = str(message)
+        self.status_code = status_code
         super().__init__(self.message)
 
     def __str__(self):
         return self.message
 
+    @property
+    def retryable(self) -> bool:
+        """Сетевые ошибки, таймауты, 429 и 5xx имеет смысл повторить"""
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+class FragmentCircuitOpenError(FragmentAPIError):
+    """Fragment API недоступен, запрос отклонен без обращения к сети"""
+    pass
+
+# Переопределяется переменной окружения, например для локального stub-сервера
+FRAGMENT_API_URL = os.getenv("FRAGMENT_API_URL", "https://api.fragment-api.net")
+
+# Покупки в блокчейне бывают долгими, поэтому таймаут больше общего
+FRAGMENT_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+# Чтения (getUserInfo, getOrders...) не должны держать запрос пользователя полминуты
+FRAGMENT_READ_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+
+# Сколько явно переданных seed/cookies держать закодированными
+ENCODED_CREDENTIALS_CACHE_SIZE = 32
+
+def extract_orders(response: Any) -> List[Dict[str, Any]]:
+    """Список заказов из ответа getOrders (формат ответа бывает разным)"""
+    if isinstance(response, list):
+        orders = response
+    elif isinstance(response, dict):
+        orders = response.get("orders") or response.get("data") or response.get("result") or []
+    else:
+        orders = []
+    return [order for order in orders if isinstance(order, dict)]
+
+def order_id(order: Dict[str, Any]) -> Optional[str]:
+    value = order.get("id") or order.get("order_id")
+    return str(value) if value is not None else None
+
+def order_recipient(order: Dict[str, Any]) -> str:
+    """Username получателя заказа, без @ и в нижнем регистре"""
+    return str(order.get("username") or order.get("recipient") or "").lstrip("@").lower()
+
+def order_amount(order: Dict[str, Any]) -> Optional[int]:
+    try:
+        return int(float(order.get("amount") or order.get("quantity") or 0))
+    except (TypeError, ValueError):
+        return None
+
+def parse_order_time(order: Dict[str, Any]) -> Optional[datetime]:
+    """Время заказа Fragment (UTC): unix timestamp или ISO-строка"""
+    value = order.get("created_at") or order.get("date")
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.utcfromtimestamp(value)
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        return None
+
 class AsyncFragmentAPIClient:
-    def __init__(self, seed: str = None, fragment_cookies: str = None, base_url="https://api.fragment-api.net"):
+    def __init__(self, seed: str = None, fragment_cookies: str = None, base_url=FRAGMENT_API_URL,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 max_concurrency: int = 10,
+                 read_timeout: httpx.Timeout = FRAGMENT_READ_TIMEOUT):
         self.base_url = base_url.rstrip("/")
         self.default_seed = seed
         self.default_fragment_cookies = fragment_cookies
-        self._session = None
+        # Внешний клиент (общий пул приложения) не закрываем — им владеет вызывающий
+        self._client = http_client
+        self._owns_client = http_client is None
+
+        # Повторяются только идемпотентные вызовы; покупки — ровно одна попытка
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.read_timeout = read_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._stats: Dict[str, EndpointStats] = {}
+
+        # Учетные данные по умолчанию кодируются один раз; невалидные дадут ошибку при вызове
+        self._encoded: Dict[Tuple[str, str], str] = {}
+        self._default_auth: Dict[Tuple[bool, bool], Dict[str, str]] = {}
+        for use_seed, use_cookies in ((True, False), (False, True), (True, True)):
+            try:
+                self._default_auth[(use_seed, use_cookies)] = self._auth_fields(
+                    use_seed=use_seed, use_cookies=use_cookies
+                )
+            except FragmentAPIError:
+                pass
 
     async def __aenter__(self):
         """Async context manager entry"""
-        timeout = aiohttp.ClientTimeout(total=30, connect=10)
-        self._session = aiohttp.ClientSession(timeout=timeout)
+        self._get_client()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit"""
-        if self._session:
-            await self._session.close()
-            self._session = None
+        await self.close()
 
-    def _get_session(self):
-        """Get or create session for standalone usage"""
-        if self._session is None:
-            timeout = aiohttp.ClientTimeout(total=30, connect=10)
-            self._session = aiohttp.ClientSession(timeout=timeout)
-        return self._session
+    def _get_client(self) -> httpx.AsyncClient:
+        """Get or create client for standalone usage"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=FRAGMENT_TIMEOUT)
+            self._owns_client = True
+        return self._client
 
     async def close(self):
-        """Manually close session"""
-        if self._session:
-            await self._session.close()
-            self._session = None
+        """Manually close client"""
+        if self._client is not None and self._owns_client:
+            await self._client.aclose()
+            self._client = None
 
-    async def _get(self, path: str) -> Dict[str, Any]:
-        session = self._get_session()
-        url = f"{self.base_url}{path}"
-        
-        try:
-            async with session.get(url) as response:
-                text = await response.text()
-                
-                if not response.ok:
-                    logger.error(f"GET {url} failed with status {response.status}: {text}")
-                    raise FragmentAPIError(f"{response.status} | {text}")
-                
-                try:
-                    return await response.json()
-                except Exception as json_error:
-                    logger.error(f"Failed to parse JSON response: {json_error}")
-                    raise FragmentAPIError(f"Invalid JSON response: {text}")
-                    
-        except aiohttp.ClientError as e:
-            logger.error(f"Network error for GET {url}: {e}")
-            raise FragmentAPIError(f"Network error: {str(e)}")
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout for GET {url}")
-            raise FragmentAPIError("Request timeout")
+    def metrics(self) -> Dict[str, Any]:
+        """Задержки, ошибки и повторы по endpoint'ам и состояние размыкателя"""
+        return {
+            "circuit_breaker": self.circuit_breaker.to_dict(),
+            "in_flight": self._in_flight,
+            "endpoints": {path: stats.to_dict() for path, stats in self._stats.items()},
+        }
+
+    async def _request(self, method: str, path: str, data: Optional[Dict[str, Any]] = None,
+                       idempotent: bool = False) -> Dict[str, Any]:
+        stats = self._stats.setdefault(path, EndpointStats())
+        attempts = self.retry_policy.attempts if idempotent else 1
 
-    async def _post(self, path: str, data: Dict[str, Any]) -> Dict[str, Any]:
-        session = self._get_session()
+        for attempt in range(1, attempts + 1):
+            if not self.circuit_breaker.allow():
+                stats.rejected += 1
+                raise FragmentCircuitOpenError("Fragment API is unavailable (circuit open)")
+
+            started = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    self._in_flight += 1
+                    try:
+                        result = await self._send(method, path, data, idempotent)
+                    finally:
+                        self._in_flight -= 1
+            except FragmentAPIError as e:
+                stats.record((time.perf_counter() - started) * 1000, error=True)
+                if not e.retryable:
+                    # 4xx — ответ API, а не его недоступность
+                    self.circuit_breaker.record_success()
+                    raise
+                self.circuit_breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                stats.retries += 1
+                delay = self.retry_policy.delay(attempt)
+                logger.warning(f"Retrying {method} {path} in {delay:.2f}s (attempt {attempt} failed: {e})")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Иначе после отмены пробного запроса размыкатель не закроется никогда
+                self.circuit_breaker.release()
+                raise
+
+            stats.record((time.perf_counter() - started) * 1000, error=False)
+            self.circuit_breaker.record_success()
+            return result
+
+    async def _send(self, method: str, path: str, data: Optional[Dict[str, Any]],
+                    idempotent: bool) -> Dict[str, Any]:
+        client = self._get_client()
         url = f"{self.base_url}{path}"
+        timeout = self.read_timeout if idempotent else FRAGMENT_TIMEOUT
         
         try:
-            # Логируем отправляемые данные (без чувствительной информации)
-            safe_data = {k: ("***" if "cookie" in k.lower() or "seed" in k.lower() else v) 
-                        for k, v in data.items()}
-            logger.debug(f"POST {url} with data: {safe_data}")
+            if method == "GET":
+                response = await client.get(url, timeout=timeout)
+            else:
+                # Логируем отправляемые данные (без чувствительной информации)
+                if logger.isEnabledFor(logging.DEBUG):
+                    safe_data = {k: ("***" if "cookie" in k.lower() or "seed" in k.lower() else v)
+                                for k, v in data.items()}
+                    logger.debug("POST %s with data: %s", url, safe_data)
+                response = await client.post(url, json=data, timeout=timeout)
+            text = response.text
             
-            async with session.post(url, json=data) as response:
-                text = await response.text()
-                
-                if not response.ok:
-                    logger.error(f"POST {url} failed with status {response.status}: {text}")
-                    raise FragmentAPIError(f"{response.status} | {text}")
-                
-                try:
-                    json_response = await response.json()
-                    logger.debug(f"Response from {url}: {json_response}")
-                    return json_response
-                except Exception as json_error:
-                    logger.error(f"Failed to parse JSON response: {json_error}")
-                    raise FragmentAPIError(f"Invalid JSON response: {text}")
+            if not response.is_success:
+                logger.error(f"{method} {url} failed with status {response.status_code}: {text}")
+                raise FragmentAPIError(f"{response.status_code} | {text}", status_code=response.status_code)
+            
+            try:
+                json_response = response.json()
+                logger.debug("Response from %s: %.500s", url, json_response)
+                return json_response
+            except Exception as json_error:
+                logger.error(f"Failed to parse JSON response: {json_error}")
+                raise FragmentAPIError(f"Invalid JSON response: {text}", status_code=response.status_code)
                     
-        except aiohttp.ClientError as e:
-            logger.error(f"Network error for POST {url}: {e}")
-            raise FragmentAPIError(f"Network error: {str(e)}")
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout for POST {url}")
+        except httpx.TimeoutException:
+            logger.error(f"Timeout for {method} {url}")
             raise FragmentAPIError("Request timeout")
+        except httpx.HTTPError as e:
+            logger.error(f"Network error for {method} {url}: {e}")
+            raise FragmentAPIError(f"Network error: {str(e)}")
+
+    async def _get(self, path: str) -> Dict[str, Any]:
+        return await self._request("GET", path, idempotent=True)
+
+    async def _post(self, path: str, data: Dict[str, Any], idempotent: bool = False) -> Dict[str, Any]:
+        return await self._request("POST", path, data, idempotent=idempotent)
     
     def _base64_encode(self, data: str) -> str:
         """Безопасное кодирование в base64"""
@@ -150,14 +271,43 @@ class AsyncFragmentAPIClient:
             logger.error(f"Error encoding data to base64: {e}")
             raise FragmentAPIError(f"Failed to encode data: {str(e)}")
 
+    def _memoized(self, kind: str, value: Any, encode) -> str:
+        """Закодированные учетные данные считаются один раз на значение"""
+        if not isinstance(value, str):
+            return encode(value)
+        key = (kind, value)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            encoded = encode(value)
+            if len(self._encoded) >= ENCODED_CREDENTIALS_CACHE_SIZE:
+                self._encoded.clear()
+            self._encoded[key] = encoded
+        return encoded
+
+    def _auth_fields(self, seed: str = None, fragment_cookies: str = None,
+                     use_seed: bool = True, use_cookies: bool = False) -> Dict[str, str]:
+        """Поля авторизации тела запроса; для аккаунта по умолчанию — готовый шаблон"""
+        if seed is None and fragment_cookies is None:
+            template = self._default_auth.get((use_seed, use_cookies))
+            if template is not None:
+                return template
+        fields = {}
+        if use_cookies:
+            fields["fragment_cookies"] = self._get_fragment_cookies(fragment_cookies)
+        if use_seed:
+            fields["seed"] = self._get_seed(seed)
+        return fields
+
     def _get_seed(self, seed: str = None) -> str:
         """Получить и валидировать seed"""
+        if seed is None:
+            if self.default_seed is None:
+                raise FragmentAPIError("Seed not provided and no default seed set.")
+            seed = self.default_seed
+        return self._memoized("seed", seed, self._encode_seed)
+
+    def _encode_seed(self, seed: str) -> str:
         try:
-            if seed is None:
-                if self.default_seed is None:
-                    raise FragmentAPIError("Seed not provided and no default seed set.")
-                seed = self.default_seed
-            
             if not isinstance(seed, str):
                 raise FragmentAPIError("Seed must be a string.")
             
@@ -177,12 +327,14 @@ class AsyncFragmentAPIClient:
 
     def _get_fragment_cookies(self, fragment_cookies: str = None) -> str:
         """Получить и валидировать fragment cookies"""
+        if fragment_cookies is None:
+            if self.default_fragment_cookies is None:
+                raise FragmentAPIError("Fragment cookies not provided and no default set.")
+            fragment_cookies = self.default_fragment_cookies
+        return self._memoized("fragment_cookies", fragment_cookies, self._encode_fragment_cookies)
+
+    def _encode_fragment_cookies(self, fragment_cookies: str) -> str:
         try:
-            if fragment_cookies is None:
-                if self.default_fragment_cookies is None:
-                    raise FragmentAPIError("Fragment cookies not provided and no default set.")
-                fragment_cookies = self.default_fragment_cookies
-            
             if not isinstance(fragment_cookies, str):
                 raise FragmentAPIError("Fragment cookies must be a string.")
             
@@ -210,8 +362,8 @@ class AsyncFragmentAPIClient:
     async def get_balance(self, seed: str = None) -> Dict[str, Any]:
         """Получить баланс кошелька"""
         try:
-            data = {"seed": self._get_seed(seed)}
-            return await self._post("/getBalance", data)
+            data = dict(self._auth_fields(seed))
+            return await self._post("/getBalance", data, idempotent=True)
         except Exception as e:
             logger.error(f"Get balance failed: {e}")
             raise
@@ -232,11 +384,11 @@ class AsyncFragmentAPIClient:
             
             data = {
                 "username": username,
-                "fragment_cookies": self._get_fragment_cookies(fragment_cookies)
+                **self._auth_fields(fragment_cookies=fragment_cookies, use_seed=False, use_cookies=True)
             }
             
-            logger.info(f"Getting user info for username: {username}")
-            result = await self._post("/getUserInfo", data)
+            logger.debug("Getting user info for username: %s", username)
+            result = await self._post("/getUserInfo", data, idempotent=True)
             
             # Дополнительная валидация ответа
             if not isinstance(result, dict):
@@ -258,8 +410,7 @@ class AsyncFragmentAPIClient:
             req_data = {
                 "username": username,
                 "amount": amount,
-                "fragment_cookies": self._get_fragment_cookies(fragment_cookies),
-                "seed": self._get_seed(seed),
+                **self._auth_fields(seed, fragment_cookies, use_cookies=True),
                 "show_sender": show_sender
             }
             return await self._post("/buyStars", req_data)
@@ -273,7 +424,7 @@ class AsyncFragmentAPIClient:
             req_data = {
                 "username": username,
                 "amount": amount,
-                "seed": self._get_seed(seed)
+                **self._auth_fields(seed)
             }
             return await self._post("/buyStarsWithoutKYC", req_data)
         except Exception as e:
@@ -286,8 +437,7 @@ class AsyncFragmentAPIClient:
         try:
             req_data = {
                 "username": username,
-                "fragment_cookies": self._get_fragment_cookies(fragment_cookies),
-                "seed": self._get_seed(seed),
+                **self._auth_fields(seed, fragment_cookies, use_cookies=True),
                 "duration": duration,
                 "show_sender": show_sender
             }
@@ -304,7 +454,7 @@ class AsyncFragmentAPIClient:
                 
             req_data = {
                 "username": username,
-                "seed": self._get_seed(seed),
+                **self._auth_fields(seed),
                 "duration": duration
             }
             return await self._post("/buyPremiumWithoutKYC", req_data)
@@ -316,11 +466,48 @@ class AsyncFragmentAPIClient:
         """Получить список заказов"""
         try:
             req_data = {
-                "seed": self._get_seed(seed),
+                **self._auth_fields(seed),
                 "limit": limit,
                 "offset": offset
             }
-            return await self._post("/getOrders", req_data)
+            return await self._post("/getOrders", req_data, idempotent=True)
         except Exception as e:
             logger.error(f"Get orders failed: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    async def _orders_page(self, seed: Optional[str], limit: int, offset: int) -> List[Dict[str, Any]]:
+        return extract_orders(await self.get_orders(seed=seed, limit=limit, offset=offset))
+
+    async def iter_orders(self, seed: str = None, page_size: int = 100,
+                          stop_at_id: Optional[str] = None,
+                          since: Optional[datetime] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Заказы от новых к старым, по одному, с постраничной подгрузкой.
+
+        Следующая страница запрашивается, пока вызывающий обрабатывает текущую.
+        Останавливается на заказе stop_at_id (не включая его) или на первом
+        заказе старше since — водяной знак предыдущего прохода.
+        """
+        stop_at_id = str(stop_at_id) if stop_at_id is not None else None
+        offset = 0
+        next_page: Optional[asyncio.Task] = asyncio.create_task(self._orders_page(seed, page_size, offset))
+        try:
+            while next_page is not None:
+                orders = await next_page
+                next_page = None
+                offset += page_size
+                if len(orders) >= page_size:
+                    next_page = asyncio.create_task(self._orders_page(seed, page_size, offset))
+
+                for order in orders:
+                    if stop_at_id is not None and order_id(order) == stop_at_id:
+                        return
+                    if since is not None:
+                        created_at = parse_order_time(order)
+                        if created_at is not None and created_at < since:
+                            return
+                    yield order
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+                # Не оставляем "Task exception was never retrieved"
+                next_page.add_done_callback(lambda task: task.cancelled() or task.exception())
@@ -0,0 +1,102 @@
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class RetryPolicy:
+    """Повторы с экспоненциальным backoff и full jitter"""
+    attempts: int = 3
+    base_delay: float = 0.3
+    max_delay: float = 3.0
+
+    def delay(self, attempt: int) -> float:
+        """Пауза перед повтором номер attempt (с 1)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Размыкатель: после failure_threshold ошибок подряд запросы
+    отклоняются сразу, через reset_timeout пропускается одна пробная попытка.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        # HALF_OPEN: только один пробный запрос
+        if self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def release(self):
+        """Вызов завершился без результата (отмена, непредвиденная ошибка):
+        освободить пробную попытку, не меняя состояние"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def to_dict(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "open_for_s": round(time.monotonic() - self.opened_at, 1) if self.opened_at else None,
+        }
+
+
+@dataclass
+class EndpointStats:
+    """Счетчики вызовов одного endpoint'а"""
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    rejected: int = 0  # Отклонено размыкателем
+    total_latency_ms: float = 0.0
+    max_latency_ms: float = 0.0
+
+    def record(self, latency_ms: float, error: bool):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_latency_ms += latency_ms
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "error_rate": round(self.errors / self.calls, 4) if self.calls else 0.0,
+            "avg_latency_ms": round(self.total_latency_ms / self.calls, 1) if self.calls else None,
+            "max_latency_ms": round(self.max_latency_ms, 1),
+        }
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import html
+import logging
+import os
+import re
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_PHOTO_SRC_RE = re.compile(r'src="([^"]*)"')
+
+
+def avatar_path(username: str, digest: Optional[str] = None) -> str:
+    """URL локального аватара; с digest — неизменяемая версия"""
+    path = f"/api/avatar/{quote(username.strip().lstrip('@'))}"
+    return f"{path}?v={digest}" if digest else path
+
+
+@dataclass
+class AvatarInfo:
+    first_name: str
+    source_url: Optional[str] = None  # Фото на CDN Telegram, None — аватар из инициалов
+    found: bool = True
+
+    def to_response(self, username: str) -> Dict:
+        return {
+            "photo_url": avatar_path(username, avatar_store.known_digest(self)),
+            "first_name": self.first_name,
+            "success": True
+        }
+
+
+async def fetch_avatar(fragment_client, username: str) -> AvatarInfo:
+    """Запросить пользователя у Fragment и вытащить URL фото из HTML ответа"""
+    user_info = await fragment_client.get_user_info(username)
+
+    if not user_info or not isinstance(user_info, dict):
+        raise ValueError("Invalid API response")
+
+    if not user_info.get('success') or not user_info.get('found'):
+        logger.info(f"User {username} not found in Fragment API")
+        return AvatarInfo(username, found=False)
+
+    user_name = user_info.get('name') or user_info.get('username') or username
+    photo_html = user_info.get('photo') or ''
+
+    src_match = _PHOTO_SRC_RE.search(photo_html)
+    if src_match:
+        return AvatarInfo(user_name, src_match.group(1))
+
+    if photo_html.strip():
+        logger.warning(f"Could not extract src from photo HTML: {photo_html}")
+    return AvatarInfo(user_name)
+
+
+def initials_svg(name: str, size: int = 128, background: str = "#4E7FFF") -> bytes:
+    """Аватар из инициалов (вместо ui-avatars.com)"""
+    words = [word for word in re.split(r"[\s_]+", name.strip().lstrip('@')) if word]
+    initials = "".join(word[0] for word in words[:2]).upper() or "?"
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+        f'<rect width="100%" height="100%" fill="{background}"/>'
+        f'<text x="50%" y="50%" dy=".35em" text-anchor="middle" fill="#fff" '
+        f'font-family="Helvetica, Arial, sans-serif" font-size="{size * 0.4:.0f}">{html.escape(initials)}</text>'
+        f'</svg>'
+    ).encode("utf-8")
+
+
+class AvatarStore:
+    """Контентно-адресуемый дисковый кэш картинок аватаров.
+
+    Файл называется sha256 содержимого, поэтому один и тот же снимок хранится
+    один раз, а digest служит ETag. При превышении max_bytes удаляются файлы,
+    которые дольше всего не отдавались (mtime обновляется при отдаче).
+    По умолчанию лежит в ./data рядом с БД, на томе, который переживает
+    пересоздание контейнера.
+    """
+
+    # Скачанный SVG может содержать скрипты, поэтому .svg — только свои инициалы
+    EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/gif": ".gif"}
+    MAX_IMAGE_BYTES = 2 * 1024 * 1024
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.directory = directory or os.getenv("AVATAR_CACHE_DIR", os.path.join("data", "avatar_cache"))
+        self.max_bytes = max_bytes or int(os.getenv("AVATAR_CACHE_MAX_MB", "100")) * 1024 * 1024
+        # Источник (URL фото или инициалы) -> имя файла
+        self._by_source = TTLCache(maxsize=20000, ttl=6 * 3600)
+        self._total_bytes: Optional[int] = None
+        self._evicting = False
+
+    @staticmethod
+    def _source_key(info: AvatarInfo) -> str:
+        return info.source_url or f"initials:{info.first_name}"
+
+    def known_digest(self, info: AvatarInfo) -> Optional[str]:
+        filename = self._by_source.get(self._source_key(info))
+        return filename.split(".")[0] if filename else None
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    # Методы _write_file, _directory_size и _evict_files выполняются в потоке
+    # и работают только с файлами; индекс и учет размера меняются в event loop
+
+    def _write_file(self, content: bytes, extension: str) -> Tuple[str, bool]:
+        """Записать файл; второй элемент — False, если такой уже был"""
+        filename = hashlib.sha256(content).hexdigest() + extension
+        path = self._path(filename)
+        if os.path.exists(path):
+            os.utime(path)
+            return filename, False
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{id(content)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return filename, True
+
+    def _directory_size(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def _evict_files(self, target: float) -> Tuple[int, int]:
+        """Удалить самые давно отданные файлы до target байт: (осталось байт, удалено файлов)"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        removed = 0
+        for entry in entries:
+            if total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return total, removed
+
+    async def _account(self, size: int):
+        """Учесть новый файл и при превышении лимита очистить кэш до 90%"""
+        if self._total_bytes is None:
+            self._total_bytes = await asyncio.to_thread(self._directory_size)
+        else:
+            self._total_bytes += size
+        if self._total_bytes <= self.max_bytes or self._evicting:
+            return
+
+        self._evicting = True
+        try:
+            total, removed = await asyncio.to_thread(self._evict_files, self.max_bytes * 0.9)
+        finally:
+            self._evicting = False
+        self._total_bytes = total
+        # Ссылки на удаленные файлы пересоздадутся при следующем запросе
+        self._by_source.clear()
+        logger.info(f"🧹 Avatar cache evicted {removed} files, {total / 1024 / 1024:.1f} MB left")
+
+    def _existing(self, info: AvatarInfo) -> Optional[str]:
+        filename = self._by_source.get(self._source_key(info))
+        if filename and os.path.exists(self._path(filename)):
+            return filename
+        return None
+
+    async def get_file(self, info: AvatarInfo, http_clients=None) -> Tuple[str, str]:
+        """Путь к файлу аватара и его digest; фото скачивается один раз"""
+        filename = self._existing(info)
+        if filename is None:
+            content, extension, fallback = None, ".svg", False
+            if info.source_url:
+                try:
+                    content, extension = await self._download(info.source_url, http_clients)
+                except Exception as e:
+                    logger.warning(f"Failed to download avatar {info.source_url}: {e}")
+                    fallback = True
+            if content is None:
+                content = initials_svg(info.first_name)
+            filename, written = await asyncio.to_thread(self._write_file, content, extension)
+            if written:
+                await self._account(len(content))
+            # Инициалы вместо неудавшейся загрузки не запоминаем — попробуем снова позже
+            if not fallback:
+                self._by_source[self._source_key(info)] = filename
+        else:
+            await asyncio.to_thread(os.utime, self._path(filename))
+        return self._path(filename), filename.split(".")[0]
+
+    async def _download(self, url: str, http_clients=None) -> Tuple[bytes, str]:
+        if http_clients is not None:
+            response = await http_clients.get_client(url).get(url)
+        else:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(url)
+        response.raise_for_status()
+
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        extension = self.EXTENSIONS.get(content_type)
+        if extension is None:
+            raise ValueError(f"Unsupported content type: {content_type}")
+        if len(response.content) > self.MAX_IMAGE_BYTES:
+            raise ValueError(f"Image too large: {len(response.content)} bytes")
+        return response.content, extension
+
+
+class AvatarCache:
+    """Кэш username -> аватар для /api/getPhoto.
+
+    Найденные пользователи живут ttl, ненайденные — более короткий
+    negative_ttl. TTLCache вытесняет по LRU при достижении maxsize.
+    Параллельные запросы одного username ждут один общий запрос к Fragment.
+    Ошибки Fragment не кэшируются.
+    """
+
+    def __init__(self, maxsize: int = 5000, ttl: float = 6 * 3600, negative_ttl: float = 10 * 60):
+        self._found = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._not_found = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _key(username: str) -> str:
+        return username.strip().lstrip('@').lower()
+
+    def get_cached(self, username: str) -> Optional[AvatarInfo]:
+        key = self._key(username)
+        info = self._found.get(key)
+        if info is not None:
+            self.hits += 1
+            return info
+        info = self._not_found.get(key)
+        if info is not None:
+            self.negative_hits += 1
+        return info
+
+    async def get(self, fragment_client, username: str) -> AvatarInfo:
+        cached = self.get_cached(username)
+        if cached is not None:
+            return cached
+
+        key = self._key(username)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        # Запрос к Fragment — отдельная задача: отмена запроса, который ее
+        # начал (клиент отключился), не отменяет ее для остальных ожидающих
+        task = asyncio.create_task(self._fetch(fragment_client, username, key))
+        self._inflight[key] = task
+        task.add_done_callback(partial(self._fetch_done, key))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, fragment_client, username: str, key: str) -> AvatarInfo:
+        info = await fetch_avatar(fragment_client, username)
+        (self._found if info.found else self._not_found)[key] = info
+        return info
+
+    def _fetch_done(self, key: str, task: asyncio.Task):
+        del self._inflight[key]
+        # Все ожидающие могли быть отменены; глушим "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        served_without_fragment = self.hits + self.negative_hits + self.coalesced
+        return {
+            "size": len(self._found),
+            "negative_size": len(self._not_found),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round(served_without_fragment / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Глобальные экземпляры
+avatar_cache = AvatarCache()
+avatar_store = AvatarStore()
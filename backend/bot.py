@@ -1,15 +1,18 @@
 import asyncio
 import logging
 import os
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, CallbackQuery
+from aiogram import Bot, Router, F
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, CallbackQuery, Update
 from aiogram.filters import CommandStart
-from aiogram.fsm.storage.memory import MemoryStorage
+from cachetools import LRUCache
 from dotenv import load_dotenv
 
 from database import AsyncSessionLocal, init_db, init_default_data
 from storage import Storage
 from schemas import UserCreate
+from fsm_storage import create_fsm_storage
+from logging_setup import setup_logging
+from update_workers import UpdateWorkerPool, WorkerPoolDispatcher
 
 # Load environment variables
 load_dotenv()
@@ -23,65 +26,65 @@ if not BOT_TOKEN:
 
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# FSM переживает перезапуск и общий для нескольких экземпляров бота
+storage = create_fsm_storage()
+# Обработка обновлений пулом воркеров: параллельно по чатам, по порядку внутри чата
+update_workers = UpdateWorkerPool(
+    workers=int(os.getenv("BOT_UPDATE_WORKERS", "16")),
+    queue_size=int(os.getenv("BOT_UPDATE_QUEUE_SIZE", "1000"))
+)
+dp = WorkerPoolDispatcher(storage=storage, update_workers=update_workers)
 router = Router()
 dp.include_router(router)
 
+# referral_code -> users.id: популярные коды из рекламных ссылок не ходят в БД
+referral_cache = LRUCache(maxsize=int(os.getenv("REFERRAL_CACHE_SIZE", "10000")))
+
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-async def get_or_create_user(telegram_user, referrer_user_id=None) -> bool:
-    """Get or create user in database with referral support"""
+async def get_or_create_user(telegram_user, referral_code=None):
+    """Get or create user in database with referral support, returns (user, created)"""
+    referrer_id = referral_cache.get(referral_code) if referral_code else None
     async with AsyncSessionLocal() as session:
-        storage_instance = Storage(session)
-        
-        # Проверяем, существует ли пользователь
-        existing_user = await storage_instance.get_user_by_telegram_id(str(telegram_user.id))
-        
-        if existing_user:
-            return False  # Пользователь уже существует
-        
-        # Создаем нового пользователя
         user_data = UserCreate(
             telegram_id=str(telegram_user.id),
             first_name=telegram_user.first_name,
             last_name=telegram_user.last_name,
             username=telegram_user.username,
-            referrer_user_id=referrer_user_id
+            referred_by=referrer_id
+        )
+        # Код не в кэше — реферер ищется подзапросом в том же INSERT
+        user, created = await Storage(session).get_or_create_user(
+            user_data, None if referrer_id else referral_code
         )
-        
-        await storage_instance.create_user(user_data)
-        return True  # Новый пользователь создан
+
+    if created:
+        referral_cache[user.referral_code] = user.id
+        if referral_code and user.referred_by:
+            referral_cache[referral_code] = user.referred_by
+    return user, created
 
 @router.message(CommandStart())
 async def start_command(message: Message):
     """Handle /start command with referral support"""
     user = message.from_user
-    referrer_user_id = None
+    referral_code = None
     
     # Проверяем наличие реферального кода
     if message.text and len(message.text.split()) > 1:
         start_param = message.text.split()[1]
         if start_param.startswith('ref'):
             referral_code = start_param[3:]  # Убираем префикс 'ref'
-            async with AsyncSessionLocal() as session:
-                storage_instance = Storage(session)
-                referrer = await storage_instance.get_user_by_referral_code(referral_code)
-                if referrer:
-                    referrer_user_id = referrer.id
     
     # Создаем или получаем пользователя
-    is_new_user = await get_or_create_user(user, referrer_user_id)
+    db_user, is_new_user = await get_or_create_user(user, referral_code)
     
     welcome_text = "🎉 <b>Добро пожаловать в StarsGuru!</b>\n\n"
     welcome_text += "💫 Покупайте Telegram Stars и TON для себя или других пользователей!\n\n"
     
-    if referrer_user_id and is_new_user:
+    if is_new_user and db_user.referred_by:
         welcome_text += "🎁 <b>Вы пришли по реферальной ссылке!</b>\n"
         welcome_text += "Ваш друг получит бонус за приглашение!\n\n"
     
@@ -207,6 +210,29 @@ async def default_handler(message: Message):
         reply_markup=keyboard
     )
 
+# Webhook-режим: обновления приходят в FastAPI (main.py), отдельный процесс не нужен
+async def setup_webhook(url: str, secret_token: str):
+    """Зарегистрировать webhook у Telegram"""
+    await bot.set_webhook(
+        url,
+        secret_token=secret_token,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"Bot webhook set to {url}")
+
+
+async def feed_webhook_update(data: dict):
+    """Передать обновление из webhook в очередь воркеров"""
+    update = Update.model_validate(data, context={"bot": bot})
+    await dp.feed_update(bot, update)
+
+
+async def close_webhook():
+    await update_workers.stop()
+    await dp.storage.close()
+    await bot.session.close()
+
+
 async def main():
     """Main function to run the bot"""
     try:
@@ -214,13 +240,17 @@ async def main():
         await init_db()
         await init_default_data()
         
-        # Start polling
+        # Start polling; webhook от webhook-режима мешает getUpdates
         logger.info("Starting bot...")
-        await dp.start_polling(bot)
+        await bot.delete_webhook()
+        # Очередь и параллельность обеспечивает update_workers
+        await dp.start_polling(bot, handle_as_tasks=False)
         
     except Exception as e:
         logger.error(f"Error running bot: {e}")
     finally:
+        await update_workers.stop()
+        await dp.storage.close()
         await bot.session.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+from aiogram.types import InlineKeyboardMarkup
+from cachetools import TTLCache
+
+from database import AsyncSessionLocal
+from models import User
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас до capacity.
+
+    pause() останавливает выдачу токенов для всех отправителей сразу —
+    так один RetryAfter от Telegram тормозит всю рассылку, а не один запрос.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class BroadcastEngine:
+    """Рассылка сообщений пользователям с включенными уведомлениями.
+
+    Получатели читаются через Storage.iter_users порциями по users.id,
+    поэтому память не зависит от размера таблицы. Отправка идет через общий TokenBucket
+    (глобальный лимит Telegram ~30 сообщений/с) и не чаще per_chat_interval
+    в один чат. После каждой порции курсор и счетчики сохраняются в
+    broadcasts, и после перезапуска рассылка продолжается с места остановки.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        chunk_size: int = 500,
+        concurrency: int = 20,
+        per_chat_interval: float = 1.0,
+        max_attempts: int = 5,
+        bot: Optional[Bot] = None,
+    ):
+        self.rate = rate or float(os.getenv("BROADCAST_RATE", "25"))
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self._bot = bot
+        self._owns_bot = bot is None
+        self._bucket: Optional[TokenBucket] = None
+        self._last_sent = TTLCache(maxsize=100000, ttl=per_chat_interval)
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.retry_after_events = 0
+
+    def _get_bot(self) -> Optional[Bot]:
+        if self._bot is None:
+            token = os.getenv("BOT_TOKEN")
+            if not token:
+                logger.error("BOT_TOKEN not set, broadcasts are disabled")
+                return None
+            self._bot = Bot(token=token)
+        return self._bot
+
+    def _get_bucket(self) -> TokenBucket:
+        if self._bucket is None:
+            self._bucket = TokenBucket(self.rate)
+        return self._bucket
+
+    def is_running(self, broadcast_id: str) -> bool:
+        task = self._tasks.get(broadcast_id)
+        return task is not None and not task.done()
+
+    async def start(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Optional[str]:
+        """Создать рассылку и запустить ее в фоне, вернуть id"""
+        if self._get_bot() is None:
+            return None
+        async with AsyncSessionLocal() as session:
+            broadcast = await Storage(session).create_broadcast({
+                "text": text,
+                "reply_markup": reply_markup.model_dump_json(exclude_none=True) if reply_markup else None,
+            })
+            broadcast_id = broadcast.id
+        self._spawn(broadcast_id)
+        logger.info(f"📣 Broadcast {broadcast_id} started")
+        return broadcast_id
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные перезапуском"""
+        async with AsyncSessionLocal() as session:
+            running = [b.id for b in await Storage(session).get_running_broadcasts()]
+        if running and self._get_bot() is not None:
+            for broadcast_id in running:
+                if not self.is_running(broadcast_id):
+                    self._spawn(broadcast_id)
+            logger.info(f"📣 Resumed {len(running)} broadcasts")
+
+    def _spawn(self, broadcast_id: str):
+        self._tasks[broadcast_id] = asyncio.create_task(self._run_safe(broadcast_id))
+
+    async def _run_safe(self, broadcast_id: str):
+        try:
+            await self._run(broadcast_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Broadcast {broadcast_id} failed: {e}", exc_info=True)
+            async with AsyncSessionLocal() as session:
+                await Storage(session).update_broadcast(broadcast_id, {
+                    "status": "failed",
+                    "finished_at": datetime.utcnow(),
+                })
+        finally:
+            self._tasks.pop(broadcast_id, None)
+
+    async def _run(self, broadcast_id: str):
+        async with AsyncSessionLocal() as session:
+            broadcast = await Storage(session).get_broadcast(broadcast_id)
+            if broadcast is None:
+                return
+            text = broadcast.text
+            reply_markup = (
+                InlineKeyboardMarkup.model_validate_json(broadcast.reply_markup)
+                if broadcast.reply_markup else None
+            )
+            cursor = broadcast.cursor
+            counters = {
+                "sent": broadcast.sent or 0,
+                "failed": broadcast.failed or 0,
+                "blocked": broadcast.blocked or 0,
+            }
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(telegram_id: str):
+            async with semaphore:
+                outcome = await self._send(telegram_id, text, reply_markup)
+            counters[outcome] += 1
+
+        async def deliver_chunk(chunk):
+            await asyncio.gather(*(deliver(row.telegram_id) for row in chunk))
+            # Сбой до этой записи приведет к повторной отправке текущей порции
+            async with AsyncSessionLocal() as session:
+                await Storage(session).update_broadcast(broadcast_id, {"cursor": chunk[-1].id, **counters})
+
+        async with AsyncSessionLocal() as session:
+            chunk = []
+            async for row in Storage(session).iter_users(
+                filter=User.notifications_enabled.is_(True),
+                batch_size=self.chunk_size,
+                columns=("telegram_id",),
+                after_id=cursor,
+            ):
+                chunk.append(row)
+                if len(chunk) >= self.chunk_size:
+                    await deliver_chunk(chunk)
+                    chunk = []
+            if chunk:
+                await deliver_chunk(chunk)
+
+        async with AsyncSessionLocal() as session:
+            await Storage(session).update_broadcast(broadcast_id, {
+                "status": "completed",
+                "finished_at": datetime.utcnow(),
+                **counters,
+            })
+        logger.info(
+            f"✅ Broadcast {broadcast_id} completed: {counters['sent']} sent, "
+            f"{counters['blocked']} blocked, {counters['failed']} failed"
+        )
+
+    async def _send(self, telegram_id: str, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> str:
+        """Отправить одно сообщение: 'sent', 'blocked' или 'failed'"""
+        bot = self._get_bot()
+        bucket = self._get_bucket()
+
+        for attempt in range(1, self.max_attempts + 1):
+            last_sent = self._last_sent.get(telegram_id)
+            if last_sent is not None:
+                wait = self.per_chat_interval - (time.monotonic() - last_sent)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            await bucket.acquire()
+            self._last_sent[telegram_id] = time.monotonic()
+            try:
+                await bot.send_message(int(telegram_id), text, reply_markup=reply_markup)
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.retry_after_events += 1
+                logger.warning(f"⚠️ Telegram RetryAfter {e.retry_after}s, pausing broadcasts")
+                bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                logger.warning(f"Broadcast message to {telegram_id} rejected: {e}")
+                return "failed"
+            except TelegramNetworkError as e:
+                logger.warning(f"Network error sending broadcast to {telegram_id} (attempt {attempt}): {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        return "failed"
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks.clear()
+        if self._bot is not None and self._owns_bot:
+            await self._bot.session.close()
+            self._bot = None
+
+
+# Глобальный экземпляр
+broadcast_engine = BroadcastEngine()
@@ -28,6 +28,9 @@ class FreekassaPayment:
         
         # Allowed FreeKassa IPs for security
         self.allowed_ips = ['168.119.157.136', '168.119.60.227', '178.154.197.79', '51.250.54.238']
+        
+        # Shared HTTP client registry, set on application startup
+        self.http_clients = None
 
     def generate_sci_signature(self, shop_id: str, amount: str, secret: str, currency: str, order_id: str) -> str:
         """Generate MD5 signature for SCI payment form"""
@@ -54,6 +57,16 @@ class FreekassaPayment:
             hashlib.sha256
         ).hexdigest()
 
+    async def _api_post(self, endpoint: str, data: Dict) -> httpx.Response:
+        """POST to FreeKassa API over the shared connection pool (or a one-off client)"""
+        url = f"{self.api_url}{endpoint}"
+        headers = {'Content-Type': 'application/json'}
+        if self.http_clients is not None:
+            client = self.http_clients.get_client(url)
+            return await client.post(url, json=data, headers=headers)
+        async with httpx.AsyncClient() as client:
+            return await client.post(url, json=data, headers=headers, timeout=30)
+
     def create_payment_url(
         self, 
         order_id: str, 
@@ -145,22 +158,16 @@ class FreekassaPayment:
             data['signature'] = self.generate_api_signature(data)
             
             # Make API request
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_url}orders/create",
-                    json=data,
-                    timeout=30,
-                    headers={'Content-Type': 'application/json'}
-                )
+            response = await self._api_post("orders/create", data)
+            
+            if response.status_code == 200:
+                result = response.json()
+                logger.info(f"Created FreeKassa API payment for order {order_id}: {result}")
+                return result
+            else:
+                logger.error(f"FreeKassa API error: {response.status_code} - {response.text}")
+                raise Exception(f"API request failed: {response.status_code}")
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    logger.info(f"Created FreeKassa API payment for order {order_id}: {result}")
-                    return result
-                else:
-                    logger.error(f"FreeKassa API error: {response.status_code} - {response.text}")
-                    raise Exception(f"API request failed: {response.status_code}")
-                    
         except Exception as e:
             logger.error(f"Error creating FreeKassa API payment: {e}")
             raise
@@ -224,32 +231,26 @@ class FreekassaPayment:
             
             data['signature'] = self.generate_api_signature(data)
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_url}orders",
-                    json=data,
-                    timeout=30,
-                    headers={'Content-Type': 'application/json'}
-                )
+            response = await self._api_post("orders", data)
+            
+            if response.status_code == 200:
+                result = response.json()
+                logger.info(f"FreeKassa payment status for {order_id}: {result}")
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    logger.info(f"FreeKassa payment status for {order_id}: {result}")
-                    
-                    # Parse status
-                    if result.get('type') == 'success' and result.get('orders'):
-                        order_data = result['orders'][0]
-                        status = order_data.get('status', 0)
-                        
-                        if status == 1:
-                            return {'status': 'paid', 'response': result}
-                        elif status in [2, 8, 9]:  # cancelled, error, expired
-                            return {'status': 'cancelled', 'response': result}
-                        else:
-                            return {'status': 'pending', 'response': result}
+                # Parse status
+                if result.get('type') == 'success' and result.get('orders'):
+                    order_data = result['orders'][0]
+                    status = order_data.get('status', 0)
                     
-                return None
+                    if status == 1:
+                        return {'status': 'paid', 'response': result}
+                    elif status in [2, 8, 9]:  # cancelled, error, expired
+                        return {'status': 'cancelled', 'response': result}
+                    else:
+                        return {'status': 'pending', 'response': result}
                 
+            return None
+            
         except Exception as e:
             logger.error(f"Error checking FreeKassa payment status: {e}")
             return None
@@ -267,21 +268,15 @@ class FreekassaPayment:
             
             data['signature'] = self.generate_api_signature(data)
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_url}balance",
-                    json=data,
-                    timeout=30,
-                    headers={'Content-Type': 'application/json'}
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get('type') == 'success':
-                        return result.get('balance', [])
-                        
-                return None
-                
+            response = await self._api_post("balance", data)
+            
+            if response.status_code == 200:
+                result = response.json()
+                if result.get('type') == 'success':
+                    return result.get('balance', [])
+                    
+            return None
+            
         except Exception as e:
             logger.error(f"Error getting FreeKassa balance: {e}")
             return None
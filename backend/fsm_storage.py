@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from cachetools import TTLCache
+from sqlalchemy import and_, delete, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import AsyncSessionLocal
+from models import FSMState
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class SQLAlchemyStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states общей БД.
+
+    Данные хранятся компактным JSON; строка удаляется, когда и состояние,
+    и данные пусты, поэтому таблица содержит только активные диалоги.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal, key_builder: Optional[KeyBuilder] = None):
+        self.session_factory = session_factory
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def _upsert(self, key: StorageKey, values: Dict[str, Any], empty: bool):
+        row_key = self.key_builder.build(key)
+        async with self.session_factory() as session:
+            values = {**values, "updated_at": datetime.utcnow()}
+            await session.execute(
+                sqlite_insert(FSMState)
+                .values(key=row_key, **values)
+                .on_conflict_do_update(index_elements=[FSMState.key], set_=values)
+            )
+            if empty:
+                await session.execute(
+                    delete(FSMState).where(and_(
+                        FSMState.key == row_key,
+                        FSMState.state.is_(None),
+                        or_(FSMState.data.is_(None), FSMState.data == "{}")
+                    ))
+                )
+            await session.commit()
+
+    async def _select(self, key: StorageKey, column):
+        async with self.session_factory() as session:
+            result = await session.execute(select(column).where(FSMState.key == self.key_builder.build(key)))
+            return result.scalar_one_or_none()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._upsert(key, {"state": state}, empty=state is None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._select(key, FSMState.state)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        await self._upsert(key, {"data": payload}, empty=not data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        payload = await self._select(key, FSMState.data)
+        return json.loads(payload) if payload else {}
+
+    async def close(self) -> None:
+        pass
+
+
+class CachedStorage(BaseStorage):
+    """Read-through кэш в памяти процесса поверх любого FSM-хранилища.
+
+    Чтения в пределах ttl не идут в БД/Redis, записи проходят насквозь и
+    обновляют кэш. Другой процесс бота увидит запись не позже чем через ttl,
+    поэтому ttl должен быть коротким при нескольких экземплярах.
+    """
+
+    def __init__(self, storage: BaseStorage, ttl: float = 5.0, maxsize: int = 10000):
+        self.storage = storage
+        self._states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._data = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.storage.set_state(key, state)
+        self._states[key] = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state = self._states.get(key, _MISSING)
+        if state is not _MISSING:
+            self.hits += 1
+            return state
+        self.misses += 1
+        state = await self.storage.get_state(key)
+        self._states[key] = state
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.storage.set_data(key, data)
+        self._data[key] = data.copy()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = self._data.get(key)
+        if data is not None:
+            self.hits += 1
+            return data.copy()
+        self.misses += 1
+        data = await self.storage.get_data(key)
+        self._data[key] = data.copy()
+        return data
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """FSM-хранилище по FSM_STORAGE: sql (по умолчанию), redis или memory"""
+    backend = os.getenv("FSM_STORAGE", "sql")
+    if backend == "memory":
+        return MemoryStorage()
+
+    if backend == "redis":
+        # Нужен пакет redis; подходит любой сервер с протоколом Redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        storage = RedisStorage.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        )
+    else:
+        storage = SQLAlchemyStorage()
+
+    ttl = float(os.getenv("FSM_CACHE_TTL", "5"))
+    logger.info(f"Bot FSM storage: {backend}, cache ttl {ttl}s")
+    return CachedStorage(storage, ttl=ttl) if ttl > 0 else storage
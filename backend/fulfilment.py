@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from api import AsyncFragmentAPIClient, FragmentAPIError, order_amount, order_id, order_recipient
+from database import AsyncSessionLocal
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentFulfilment:
+    """Очередь доставки оплаченных звезд через Fragment.
+
+    Берет completed-транзакции со звездами для recipient_username
+    (delivery_status='pending'), атомарно забирает каждую в работу и
+    вызывает buy_stars не более чем concurrency запросами одновременно.
+    Ошибки повторяются с backoff; перед повтором ищем заказ в get_orders,
+    чтобы не купить звезды дважды, если первая попытка на самом деле прошла.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 3,
+        poll_interval: float = 10.0,
+        batch_size: int = 20,
+        max_attempts: int = 5,
+        base_backoff: float = 30.0,
+        max_backoff: float = 30 * 60,
+        orders_lookup_limit: int = 50,
+    ):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.orders_lookup_limit = orders_lookup_limit
+        self.without_kyc = os.getenv("FRAGMENT_BUY_WITHOUT_KYC", "0") == "1"
+        self.client: Optional[AsyncFragmentAPIClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def start(self, client: AsyncFragmentAPIClient):
+        if self._task is None:
+            self.client = client
+            self._wakeup = asyncio.Event()
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🚚 Fragment fulfilment started (concurrency {self.concurrency})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def notify(self):
+        """Разбудить очередь сразу после оплаты"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        # Доставки, прерванные перезапуском, повторяем через сверку с get_orders
+        async with AsyncSessionLocal() as session:
+            stale = await Storage(session).reset_stale_deliveries()
+            if stale:
+                logger.warning(f"⚠️ {stale} interrupted deliveries returned to the queue")
+
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"❌ Fulfilment batch failed: {e}", exc_info=True)
+                processed = 0
+
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self) -> int:
+        """Доставить одну пачку, вернуть количество взятых транзакций"""
+        async with AsyncSessionLocal() as session:
+            due = [
+                (t.id, t.recipient_username, int(t.amount), t.delivery_attempts or 0, t.delivery_started_at)
+                for t in await Storage(session).get_due_deliveries(datetime.utcnow(), self.batch_size)
+            ]
+        if due:
+            await asyncio.gather(*(self._deliver(*item) for item in due))
+        return len(due)
+
+    async def _deliver(self, transaction_id: str, username: str, amount: int,
+                       attempts: int, last_started_at: Optional[datetime]):
+        async with self._semaphore:
+            async with AsyncSessionLocal() as session:
+                storage = Storage(session)
+                if not await storage.claim_delivery(transaction_id):
+                    return
+                attempts += 1
+                username = (username or "").lstrip("@")
+
+                try:
+                    order = None
+                    if attempts > 1:
+                        order = await self._find_order(storage, transaction_id, username, amount, last_started_at)
+                    if order is not None:
+                        response = {"reconciled": True, "order": order}
+                        fragment_order_id = order_id(order)
+                        logger.info(f"🔁 Transaction {transaction_id} found in Fragment orders, not buying again")
+                    else:
+                        response = await self._buy(username, amount)
+                        fragment_order_id = order_id(response) if isinstance(response, dict) else None
+                except Exception as e:
+                    await self._schedule_retry(storage, transaction_id, attempts, e)
+                    return
+
+                await storage.update_transaction(transaction_id, {
+                    "delivery_status": "delivered",
+                    "delivery_data": json.dumps(response, ensure_ascii=False, default=str),
+                    # Заказ закреплен за транзакцией: сверка других доставок его не возьмет
+                    "fragment_order_id": fragment_order_id,
+                    "delivery_error": None,
+                    "delivery_next_attempt_at": None,
+                    "delivered_at": datetime.utcnow()
+                })
+                logger.info(f"✅ Delivered {amount} stars to @{username} (transaction {transaction_id})")
+
+    async def _buy(self, username: str, amount: int) -> Dict[str, Any]:
+        if self.without_kyc:
+            response = await self.client.buy_stars_without_kyc(username, amount)
+        else:
+            response = await self.client.buy_stars(username, amount)
+        if isinstance(response, dict) and response.get("ok") is False:
+            raise FragmentAPIError(response.get("message") or response.get("error") or response)
+        return response
+
+    async def _find_order(self, storage: Storage, transaction_id: str, username: str, amount: int,
+                          since: Optional[datetime]) -> Optional[Dict[str, Any]]:
+        """Незакрепленный заказ на username/amount, созданный не раньше предыдущей попытки.
+
+        Заказы, уже записанные за другими транзакциями, пропускаются. Если
+        одновременно идет другая доставка того же количества тому же
+        получателю, найденный заказ может оказаться ее — откладываем повтор.
+        """
+        # Допуск на расхождение часов с Fragment
+        watermark = since - timedelta(minutes=1) if since else None
+        candidates = []
+        scanned = 0
+        # aclosing: генератор прерывается досрочно и должен закрыть свой запрос
+        async with aclosing(self.client.iter_orders(page_size=self.orders_lookup_limit, since=watermark)) as orders:
+            async for order in orders:
+                scanned += 1
+                if scanned > self.orders_lookup_limit:
+                    break
+                if order_recipient(order) == username.lower() and order_amount(order) == amount:
+                    candidates.append(order)
+        if not candidates:
+            return None
+
+        claimed = await storage.get_claimed_fragment_order_ids(
+            [order_id(order) for order in candidates if order_id(order) is not None]
+        )
+        # От старых к новым: заказ нашей первой попытки создан раньше чужих повторов
+        for order in reversed(candidates):
+            if order_id(order) is None or order_id(order) not in claimed:
+                if await storage.has_concurrent_delivery(transaction_id, username, amount):
+                    raise FragmentAPIError(f"Concurrent delivery of {amount} stars to @{username}, order is ambiguous")
+                return order
+        return None
+
+    async def _schedule_retry(self, storage: Storage, transaction_id: str, attempts: int, error: Exception):
+        updates = {"delivery_error": str(error)[:1000]}
+        if attempts >= self.max_attempts:
+            updates["delivery_status"] = "failed"
+            logger.error(f"💀 Delivery for transaction {transaction_id} failed after {attempts} attempts: {error}")
+        else:
+            delay = min(self.base_backoff * 2 ** (attempts - 1), self.max_backoff)
+            updates["delivery_status"] = "pending"
+            updates["delivery_next_attempt_at"] = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"⚠️ Delivery for transaction {transaction_id} failed (attempt {attempts}), retry in {delay:.0f}s: {error}")
+        await storage.update_transaction(transaction_id, updates)
+
+
+# Глобальный экземпляр
+fragment_fulfilment = FragmentFulfilment()
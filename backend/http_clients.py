@@ -0,0 +1,126 @@
+import httpx
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from metrics import outbound_request_duration, outbound_request_errors
+
+logger = logging.getLogger(__name__)
+
+# Общие таймауты для всех внешних интеграций
+DEFAULT_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+
+
+@dataclass
+class HostStats:
+    """Счетчики запросов к одному хосту"""
+    requests: int = 0
+    errors: int = 0
+    total_latency_ms: float = 0.0
+    max_latency_ms: float = 0.0
+    last_latency_ms: Optional[float] = None
+
+    def record(self, latency_ms: float):
+        self.last_latency_ms = latency_ms
+        self.total_latency_ms += latency_ms
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+
+    def to_dict(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "avg_latency_ms": round(self.total_latency_ms / self.requests, 1) if self.requests else None,
+            "max_latency_ms": round(self.max_latency_ms, 1),
+            "last_latency_ms": round(self.last_latency_ms, 1) if self.last_latency_ms is not None else None,
+        }
+
+
+class _MetricsTransport(httpx.AsyncBaseTransport):
+    """Обертка над транспортом httpx: время до заголовков ответа и ошибки по хосту"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: HostStats, host: str):
+        self._transport = transport
+        self._stats = stats
+        self._host = host
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._stats.requests += 1
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self._record(started, error=True)
+            raise
+        self._record(started, error=response.status_code >= 500)
+        return response
+
+    def _record(self, started: float, error: bool):
+        elapsed = time.perf_counter() - started
+        self._stats.record(elapsed * 1000)
+        outbound_request_duration.observe(elapsed, self._host)
+        if error:
+            self._stats.errors += 1
+            outbound_request_errors.inc(self._host)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class HTTPClientRegistry:
+    """Пул httpx-клиентов на время жизни приложения.
+
+    На каждый хост (scheme://host:port) создается один AsyncClient с
+    keep-alive и собственным лимитом соединений, так что повторные
+    запросы не платят за TCP+TLS handshake.
+    """
+
+    def __init__(
+        self,
+        timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+        max_connections_per_host: int = 20,
+        max_keepalive_per_host: int = 10,
+        keepalive_expiry: float = 30.0,
+    ):
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_keepalive_per_host,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, HostStats] = {}
+
+    @staticmethod
+    def _host_key(url: str) -> str:
+        parts = urlsplit(url)
+        if not parts.scheme or not parts.netloc:
+            raise ValueError(f"Absolute URL expected, got: {url}")
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def get_client(self, url: str, timeout: Optional[httpx.Timeout] = None) -> httpx.AsyncClient:
+        """Клиент для хоста из url; timeout применяется только при первом создании"""
+        key = self._host_key(url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            stats = self._stats.setdefault(key, HostStats())
+            transport = _MetricsTransport(httpx.AsyncHTTPTransport(limits=self.limits), stats, urlsplit(key).netloc)
+            client = httpx.AsyncClient(transport=transport, timeout=timeout or self.timeout)
+            self._clients[key] = client
+            logger.info(f"🌐 HTTP pool created for {key}")
+        return client
+
+    def metrics(self) -> Dict[str, Dict]:
+        """Задержки и ошибки по хостам"""
+        return {host: stats.to_dict() for host, stats in self._stats.items()}
+
+    async def close(self):
+        """Закрыть все соединения"""
+        clients, self._clients = self._clients, {}
+        for key, client in clients.items():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing HTTP client for {key}: {e}")
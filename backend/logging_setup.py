@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Типы аргументов, которые можно форматировать позже в потоке listener'а
+_LAZY_ARG_TYPES = (str, int, float, bool, type(None))
+
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_sampling: Optional["SamplingFilter"] = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON; поля из extra= попадают в объект"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничение болтливых логгеров ниже WARNING.
+
+    rate_limits: имя логгера -> записей в секунду (token bucket),
+    sample_rates: имя логгера -> доля пропускаемых записей. Правило для
+    "a.b" действует и на "a.b.c". WARNING и выше проходят всегда.
+    """
+
+    def __init__(self, rate_limits: Dict[str, float] = None, sample_rates: Dict[str, float] = None):
+        super().__init__()
+        self.rate_limits = rate_limits or {}
+        self.sample_rates = sample_rates or {}
+        self._buckets: Dict[str, list] = {}
+        self._rules: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def _rule(self, name: str, rules: Dict[str, float]) -> Optional[str]:
+        while name:
+            if name in rules:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rules = self._rules.get(record.name)
+        if rules is None:
+            rules = (self._rule(record.name, self.sample_rates), self._rule(record.name, self.rate_limits))
+            self._rules[record.name] = rules
+        sample_rule, rate_rule = rules
+
+        if sample_rule is not None and random.random() >= self.sample_rates[sample_rule]:
+            self.dropped += 1
+            return False
+
+        if rate_rule is not None:
+            rate = self.rate_limits[rate_rule]
+            now = time.monotonic()
+            with self._lock:
+                bucket = self._buckets.setdefault(rate_rule, [rate, now])
+                bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    self.dropped += 1
+                    return False
+                bucket[0] -= 1
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует сообщение в потоке вызова.
+
+    Стандартный prepare() подставляет args в msg до постановки в очередь;
+    здесь это делается только для изменяемых аргументов, остальное
+    форматирует поток QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args and not all(isinstance(arg, _LAZY_ARG_TYPES) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Трейсбек держит кадры стека, форматируем сразу
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_rules(value: Optional[str]) -> Dict[str, float]:
+    """'sqlalchemy.engine=5,aiogram.event=0.1' -> {имя: число}"""
+    rules = {}
+    for item in (value or "").split(","):
+        name, _, number = item.partition("=")
+        if name.strip() and number.strip():
+            rules[name.strip()] = float(number)
+    return rules
+
+
+def setup_logging(level: Optional[str] = None, json_output: Optional[bool] = None) -> SamplingFilter:
+    """Настроить корневой логгер: запись в stdout из отдельного потока.
+
+    LOG_LEVEL — уровень, LOG_FORMAT=json — структурированный вывод,
+    LOG_RATE_LIMITS / LOG_SAMPLING — правила SamplingFilter. Повторный
+    вызов ничего не меняет.
+    """
+    global _listener, _sampling
+    if _listener is not None:
+        return _sampling
+
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    if json_output is None:
+        json_output = os.getenv("LOG_FORMAT", "text") == "json"
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(
+        JSONFormatter() if json_output
+        else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+
+    _sampling = SamplingFilter(
+        rate_limits=_parse_rules(os.getenv("LOG_RATE_LIMITS")),
+        sample_rates=_parse_rules(os.getenv("LOG_SAMPLING"))
+    )
+    queue_handler = LazyQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(_sampling)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _sampling
+
+
+def stop_logging():
+    """Дописать оставшиеся записи и остановить поток логирования"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,7 +1,7 @@
 from fastapi import FastAPI, Depends, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 from sqlalchemy import func, and_, select
@@ -14,24 +14,36 @@ from datetime import datetime, date
 from decimal import Decimal
 from dotenv import load_dotenv
 import base64
-from pyrogram import Client
-from pyrogram.errors import UsernameNotOccupied, UsernameInvalid, FloodWait, AuthKeyUnregistered
+import hmac
+import time
 from ton_price_service import ton_price_service
 
 # Load environment variables
 load_dotenv()
 
-from database import get_db, init_db, init_default_data, AsyncSessionLocal
-from api import AsyncFragmentAPIClient
+from database import get_db, init_db, init_default_data, AsyncSessionLocal, engine
+from api import AsyncFragmentAPIClient, FragmentCircuitOpenError, FRAGMENT_API_URL, FRAGMENT_TIMEOUT
+from http_clients import HTTPClientRegistry
+from logging_setup import setup_logging
+from metrics import (
+    metrics_registry, instrument_engine,
+    http_requests_total, http_request_duration, http_requests_in_progress
+)
 from storage import Storage
 from telegram_auth import get_current_user
 from freekassa import get_freekassa
+from avatars import AvatarInfo, avatar_cache, avatar_store
+from broadcast import broadcast_engine
+from fulfilment import fragment_fulfilment
+from telegram_clients import TelegramClientManager
+from order_reconciliation import order_reconciliation
+from payments import payment_event_worker, payment_reconciler, payment_status_broker, FINAL_PAYMENT_STATUSES
 from schemas import *
 from models import User, Transaction
 import json
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
+# Setup logging: вывод из отдельного потока через очередь
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Stars Exchange API", version="1.0.0")
@@ -45,17 +57,25 @@ app.add_middleware(
 )
 
 
-# Request logging middleware
+# Request logging and metrics middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = datetime.now()
-    
-    response = await call_next(request)
-    
-    duration = (datetime.now() - start_time).total_seconds() * 1000
+    started = time.perf_counter()
+    status_code = 500
+    http_requests_in_progress.inc()
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        http_requests_in_progress.dec()
+        elapsed = time.perf_counter() - started
+        # Шаблон маршрута (/api/avatar/{username}), а не сырой путь — иначе метки не ограничены
+        route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+        http_requests_total.inc(request.method, route, str(status_code))
+        http_request_duration.observe(elapsed, request.method, route)
     
     if request.url.path.startswith("/api"):
-        logger.info(f"{request.method} {request.url.path} {response.status_code} in {duration:.0f}ms")
+        logger.info(f"{request.method} {request.url.path} {response.status_code} in {elapsed * 1000:.0f}ms")
     
     return response
 
@@ -90,27 +110,12 @@ async def get_authenticated_user(
         raise HTTPException(status_code=403, detail="Invalid or missing Telegram authentication data")
     return user
 
-telegram_client = None
-connected_client = None
+# Пул пользовательских сессий Pyrogram (TELEGRAM_SESSION_STRING или TELEGRAM_SESSION_STRINGS через запятую)
+telegram_clients = TelegramClientManager()
 
 async def ensure_telegram_connection():
-    global connected_client
-    logger.info(f"Current connected_client state: {connected_client}")
-    
-    if connected_client is None:
-        logger.info("Creating new telegram connection...")
-        session_string = os.getenv('TELEGRAM_SESSION_STRING')
-        if session_string:
-            connected_client = Client("my_account", session_string=session_string)
-            await connected_client.start()
-            logger.info("Global telegram session started")
-        else:
-            logger.error("No session string found")
-            return None
-    else:
-        logger.info("Using existing telegram connection")
-    
-    return connected_client
+    """Проверить пул сессий запросом get_me; все запросы Pyrogram идут через call()"""
+    return await telegram_clients.call(lambda client: client.get_me())
 
 # User routes
 @app.post("/api/users", response_model=UserResponse)
@@ -119,12 +124,9 @@ async def create_user(
     storage: Storage = Depends(get_storage)
 ):
     try:
-        existing_user = await storage.get_user_by_telegram_id(user_data.telegram_id)
-        if existing_user:
-            return existing_user
-        
-        user = await storage.create_user(user_data)
-        logger.info(f"Created user: {user.id} telegramId: {user.telegram_id}")
+        user, created = await storage.get_or_create_user(user_data)
+        if created:
+            logger.info(f"Created user: {user.id} telegramId: {user.telegram_id}")
         return user
     except Exception as e:
         logger.error(f"Error creating user: {e}")
@@ -287,81 +289,59 @@ async def get_user_transactions_history(
 
 @app.get("/api/getPhoto")
 async def get_photo(username: str):
-    logger.info(f"Getting photo for username: {username}")
-    
     try:
-        logger.info(f"Getting photo for username: {username}")
         # Добавляем проверку на существование fragment_api_client
         if not hasattr(app.state, 'fragment_api_client') or app.state.fragment_api_client is None:
             logger.warning("Fragment API client not initialized")
-            # Возвращаем аватар по умолчанию
-            avatar_url = f"https://ui-avatars.com/api/?name={username}&size=128&background=4E7FFF&color=fff"
-            return {
-                "photo_url": avatar_url,
-                "first_name": username,
-                "success": True
-            }
-        
-        # Вызываем get_user_info с обработкой ошибок
-        user_info = await app.state.fragment_api_client.get_user_info(username)
+            return AvatarInfo(username, found=False).to_response(username)
         
-        # Проверяем результат
-        if not user_info or not isinstance(user_info, dict):
-            logger.warning(f"Invalid response from Fragment API for user {username}")
-            raise Exception("Invalid API response")
-            
-        if not user_info.get('success') or not user_info.get('found'):
-            logger.warning(f"User {username} not found in Fragment API")
-            # Возвращаем аватар по умолчанию
-            avatar_url = f"https://ui-avatars.com/api/?name={username}&size=128&background=4E7FFF&color=fff"
-            return {
-                "photo_url": avatar_url,
-                "first_name": username,
-                "success": True
-            }
-        
-        # Получаем данные пользователя из ответа API
-        user_name = user_info.get('name') or user_info.get('username') or username
-        photo_html = user_info.get('photo', '')
-        
-        logger.info(f"Found user: {user_name}, has_photo: {bool(photo_html)}")
-        
-        # Пытаемся извлечь URL фото из HTML
-        if photo_html and photo_html.strip():
-            try:
-                import re
-                src_match = re.search(r'src="([^"]*)"', photo_html)
-                if src_match:
-                    photo_url = src_match.group(1)
-                    return {
-                        "photo_url": photo_url,
-                        "first_name": user_name,
-                        "success": True
-                    }
-                else:
-                    logger.warning(f"Could not extract src from photo HTML: {photo_html}")
-            except Exception as photo_error:
-                logger.error(f"Error extracting photo URL: {photo_error}")
-        
-        # Если фото нет или произошла ошибка, используем аватар по умолчанию
-        avatar_url = f"https://ui-avatars.com/api/?name={user_name}&size=128&background=4E7FFF&color=fff"
-        return {
-            "photo_url": avatar_url,
-            "first_name": user_name,
-            "success": True
-        }
+        # Кэш + один общий запрос к Fragment на параллельные обращения
+        avatar = await avatar_cache.get(app.state.fragment_api_client, username)
+        return avatar.to_response(username)
             
+    except FragmentCircuitOpenError:
+        # Fragment недоступен: отдаем аватар по умолчанию без ожидания таймаута
+        logger.warning(f"Fragment API circuit open, default avatar for {username}")
+        return AvatarInfo(username, found=False).to_response(username)
     except Exception as e:
         # Логируем полную ошибку для отладки
         logger.error(f"Error getting photo for {username}: {str(e)}", exc_info=True)
         
         # Возвращаем аватар по умолчанию даже при ошибке
-        avatar_url = f"https://ui-avatars.com/api/?name={username}&size=128&background=4E7FFF&color=fff"
-        return {
-            "photo_url": avatar_url,
-            "first_name": username,
-            "success": True
-        }
+        return AvatarInfo(username, found=False).to_response(username)
+
+AVATAR_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+AVATAR_MUTABLE_CACHE = "public, max-age=3600"
+
+@app.get("/api/avatar/{username}")
+async def get_avatar_image(username: str, request: Request, v: Optional[str] = None):
+    """Картинка аватара из локального дискового кэша.
+
+    С ?v=<digest> (так отдает /api/getPhoto) ответ неизменяемый; без него
+    кэшируется на час и перепроверяется по ETag/If-None-Match.
+    """
+    avatar = AvatarInfo(username, found=False)
+    client = getattr(app.state, 'fragment_api_client', None)
+    if client is not None:
+        try:
+            avatar = await avatar_cache.get(client, username)
+        except Exception as e:
+            logger.warning(f"Avatar lookup failed for {username}, using initials: {e}")
+
+    path, digest = await avatar_store.get_file(avatar, getattr(app.state, 'http_clients', None))
+    headers = {
+        "ETag": f'"{digest}"',
+        "Cache-Control": AVATAR_IMMUTABLE_CACHE if v == digest else AVATAR_MUTABLE_CACHE,
+        "X-Content-Type-Options": "nosniff"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+        if digest in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, headers=headers)
 
 # Purchase routes
 @app.post("/api/purchase/calculate", response_model=PurchaseCalculateResponse)
@@ -726,48 +706,18 @@ async def freekassa_webhook(
             logger.error("Invalid FreeKassa signature")
             raise HTTPException(status_code=400, detail="Invalid signature")
         
-        # Найти транзакцию
-        transaction = await storage.get_transaction(webhook_data.MERCHANT_ORDER_ID)
-        if not transaction:
-            logger.error(f"Transaction not found: {webhook_data.MERCHANT_ORDER_ID}")
-            raise HTTPException(status_code=404, detail="Transaction not found")
-        
-        # Проверить сумму
-        expected_amount = float(transaction.rub_amount or 0)
-        received_amount = float(webhook_data.AMOUNT)
-        
-        if abs(expected_amount - received_amount) > 0.01:  # Допуск 1 копейка
-            logger.error(f"Amount mismatch: expected {expected_amount}, received {received_amount}")
-            raise HTTPException(status_code=400, detail="Amount mismatch")
-        
-        # Обновить статус транзакции
-        if transaction.status != "completed":
-            await storage.update_transaction(transaction.id, {
-                "status": "completed",
-                "paid_at": datetime.utcnow(),
-                "payment_data": json.dumps(webhook_data.dict())
-            })
-            
-            # Начислить валюту пользователю
-            if transaction.currency == "ton":
-                user = await storage.get_user(transaction.user_id)
-                if user:
-                    new_balance = user.ton_balance + transaction.amount
-                    await storage.update_user(user.id, {"ton_balance": new_balance})
-            elif transaction.currency == "stars":
-                await storage.add_user_stars(transaction.user_id, int(transaction.amount))
-            
-            # Обработать реферальный бонус
-            user = await storage.get_user(transaction.user_id)
-            if user and user.referred_by:
-                bonus_amount = int(float(transaction.amount) * 0.1)  # 10% бонус
-                await storage.process_referral_bonus(user.referred_by, bonus_amount)
-            
-            # Логирование с получателем
-            log_msg = f"FreeKassa transaction {transaction.id} completed successfully"
-            if transaction.recipient_username:
-                log_msg += f" (recipient: @{transaction.recipient_username})"
-            logger.info(log_msg)
+        # Записать событие в outbox и сразу подтвердить: начисление делает payment_event_worker.
+        # Повторная доставка того же intid упирается в уникальный ключ и тоже получает YES.
+        event = await storage.add_payment_event(
+            "freekassa",
+            webhook_data.intid or webhook_data.MERCHANT_ORDER_ID,
+            amount=Decimal(webhook_data.AMOUNT),
+            payload=json.dumps(webhook_data.dict())
+        )
+        if event:
+            payment_event_worker.notify()
+        else:
+            logger.info(f"FreeKassa webhook {webhook_data.intid} already recorded")
         
         # FreeKassa expects "YES" response for confirmation
         return "YES"
@@ -795,38 +745,7 @@ async def get_payment_status(
         if transaction.user_id != current_user.id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # If pending and has invoice_id, check with payment system
-        # If pending and has invoice_id, check with FreeKassa
-        if transaction.status == "pending" and transaction.invoice_id and transaction.payment_system == "freekassa":
-            freekassa = get_freekassa()
-            if freekassa:
-                payment_status = await freekassa.check_payment_status(transaction.invoice_id)
-                
-                if payment_status and payment_status['status'] == 'paid':
-                    # Update transaction status
-                    updates = {
-                        "status": "completed",
-                        "paid_at": datetime.utcnow(),
-                        "payment_data": payment_status['response']
-                    }
-                    await storage.update_transaction(transaction.id, updates)
-                    
-                    # Update user balance
-                    if transaction.currency == "stars":
-                        user_updates = {
-                            "stars_balance": current_user.stars_balance + int(transaction.amount),
-                            "total_stars_earned": current_user.total_stars_earned + int(transaction.amount)
-                        }
-                        await storage.update_user(current_user.id, user_updates)
-                    elif transaction.currency == "ton":
-                        user_updates = {
-                            "ton_balance": current_user.ton_balance + transaction.amount
-                        }
-                        await storage.update_user(current_user.id, user_updates)
-                    
-                    transaction.status = "completed"
-                    transaction.paid_at = datetime.utcnow()
-        
+        # Статус только из БД: pending-платежи сверяет фоновый payment_reconciler
         return PaymentStatusResponse(
             transaction_id=transaction.id,
             status=transaction.status,
@@ -839,6 +758,74 @@ async def get_payment_status(
         logger.error(f"Error getting payment status: {e}")
         raise HTTPException(status_code=500, detail="Failed to get payment status")
 
+PAYMENT_STREAM_TIMEOUT = 15 * 60  # секунд
+PAYMENT_STREAM_KEEPALIVE = 15  # секунд
+
+@app.get("/api/payment/stream/{transaction_id}")
+async def stream_payment_status(
+    transaction_id: str,
+    request: Request,
+    init_data: Optional[str] = None,
+    x_telegram_init_data: Optional[str] = Header(None)
+):
+    """SSE-поток статуса платежа вместо опроса /api/payment/status.
+
+    EventSource не умеет передавать заголовки, поэтому initData можно
+    передать query-параметром init_data.
+    """
+    # Подписываемся до чтения из БД, чтобы не пропустить завершение между ними
+    queue = payment_status_broker.subscribe(transaction_id)
+    try:
+        async with AsyncSessionLocal() as session:
+            storage = Storage(session)
+            user = await get_current_user(storage, None, x_telegram_init_data or init_data)
+            if not user:
+                raise HTTPException(status_code=403, detail="Invalid or missing Telegram authentication data")
+
+            transaction = await storage.get_transaction(transaction_id)
+            if not transaction:
+                raise HTTPException(status_code=404, detail="Transaction not found")
+            if transaction.user_id != user.id:
+                raise HTTPException(status_code=403, detail="Access denied")
+    except Exception:
+        payment_status_broker.unsubscribe(transaction_id, queue)
+        raise
+
+    current = {
+        "transaction_id": transaction.id,
+        "status": transaction.status,
+        "paid_at": transaction.paid_at.isoformat() if transaction.paid_at else None
+    }
+
+    async def events():
+        try:
+            yield f"data: {json.dumps(current)}\n\n"
+            if current["status"] in FINAL_PAYMENT_STATUSES:
+                return
+
+            deadline = asyncio.get_running_loop().time() + PAYMENT_STREAM_TIMEOUT
+            while asyncio.get_running_loop().time() < deadline:
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=PAYMENT_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE, чтобы прокси не закрыл соединение
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield f"data: {json.dumps(event)}\n\n"
+                if event["status"] in FINAL_PAYMENT_STATUSES:
+                    return
+        finally:
+            payment_status_broker.unsubscribe(transaction_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Добавить в main.py эти endpoints:
 
 @app.get("/payment/success")
@@ -1172,6 +1159,38 @@ async def get_ton_price(storage: Storage = Depends(get_storage)):
         fallback = float(fallback_price) if fallback_price and fallback_price.strip() else 420.0
         return {"price": f"{fallback:.2f}"}
 
+@app.get("/api/ton-price/history")
+async def get_ton_price_history(
+    hours: int = 24,
+    points: int = 200,
+    storage: Storage = Depends(get_storage)
+):
+    """История цены TON для графика (без запросов к биржам)"""
+    try:
+        hours = max(1, min(hours, 24 * 30))
+        points = max(2, min(points, 1000))
+        since = datetime.utcnow() - timedelta(hours=hours)
+
+        history = await ton_price_service.get_history(storage, since)
+
+        # Прореживаем равномерно, последняя точка всегда попадает в ответ
+        if len(history) > points:
+            step = len(history) / points
+            history = [history[int(i * step)] for i in range(points - 1)] + [history[-1]]
+
+        return {
+            "success": True,
+            "points": [
+                {"timestamp": created_at.isoformat(), "price": round(price, 2)}
+                for created_at, price in history
+            ],
+            "count": len(history),
+            "period_hours": hours
+        }
+    except Exception as e:
+        logger.error(f"Error getting TON price history: {e}", exc_info=True)
+        return {"success": False, "points": [], "count": 0, "period_hours": hours}
+
 @app.put("/api/admin/settings")
 async def update_admin_settings(
     settings: AdminSettingsUpdate,
@@ -1331,6 +1350,11 @@ async def create_task_admin(
         })
         
         logger.info(f"New task created: {new_task.title}")
+        if new_task.is_active and new_task.status == "active":
+            try:
+                await notify_users_new_task(new_task)
+            except Exception as e:
+                logger.error(f"Failed to start new task broadcast: {e}")
         return {"success": True, "task": new_task}
     except Exception as e:
         logger.error(f"Error creating task: {e}")
@@ -1522,7 +1546,8 @@ async def ton_diagnostics(storage: Storage = Depends(get_storage)):
                 "cache_minutes": cache_minutes,
                 "markup_percentage": markup,
                 "fallback_price": fallback
-            }
+            },
+            "sources": ton_price_service.get_source_stats()
         }
         
         # Тестовый запрос цены
@@ -1545,6 +1570,121 @@ async def ton_diagnostics(storage: Storage = Depends(get_storage)):
             }
         }
 
+@app.get("/api/admin/http-clients")
+async def http_clients_metrics():
+    """Задержки и ошибки исходящих запросов по хостам"""
+    registry = getattr(app.state, 'http_clients', None)
+    return {
+        "success": registry is not None,
+        "hosts": registry.metrics() if registry else {}
+    }
+
+@app.get("/api/admin/payment-events")
+async def payment_events_stats(storage: Storage = Depends(get_storage)):
+    """Состояние outbox платежных событий (pending / processed / dead)"""
+    return {
+        "success": True,
+        "counts": await storage.get_payment_event_counts()
+    }
+
+@app.get("/api/admin/fulfilment")
+async def fulfilment_stats(storage: Storage = Depends(get_storage)):
+    """Состояние доставки звезд через Fragment"""
+    return {
+        "success": True,
+        "running": fragment_fulfilment.running,
+        "counts": await storage.get_delivery_counts()
+    }
+
+@app.post("/api/admin/fulfilment/{transaction_id}/retry")
+async def retry_fulfilment(transaction_id: str, storage: Storage = Depends(get_storage)):
+    """Вернуть неудавшуюся доставку в очередь"""
+    transaction = await storage.get_transaction(transaction_id)
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    if transaction.delivery_status != "failed":
+        raise HTTPException(status_code=400, detail=f"Delivery status is {transaction.delivery_status}")
+    
+    # Счетчик 1: следующая попытка начнется со сверки с get_orders
+    await storage.update_transaction(transaction_id, {
+        "delivery_status": "pending",
+        "delivery_attempts": 1,
+        "delivery_next_attempt_at": None
+    })
+    fragment_fulfilment.notify()
+    return {"success": True}
+
+@app.get("/api/admin/fragment-metrics")
+async def fragment_metrics():
+    """Задержки, ошибки и состояние размыкателя Fragment API по endpoint'ам"""
+    client = getattr(app.state, 'fragment_api_client', None)
+    return {
+        "success": client is not None,
+        "metrics": client.metrics() if client else {},
+        "avatar_cache": avatar_cache.stats()
+    }
+
+@app.post("/api/admin/reconcile-orders")
+async def start_order_reconciliation(days: int = 30):
+    """Запустить сверку оплаченных звезд с заказами Fragment за последние days дней"""
+    client = getattr(app.state, 'fragment_api_client', None)
+    if client is None:
+        raise HTTPException(status_code=503, detail="Fragment API client not initialized")
+    
+    since = datetime.utcnow() - timedelta(days=days)
+    if not order_reconciliation.start(client, since):
+        raise HTTPException(status_code=409, detail="Reconciliation is already running")
+    return {"success": True, "since": since.isoformat()}
+
+@app.get("/api/admin/reconcile-orders")
+async def get_order_reconciliation():
+    """Статус и отчет последней сверки с Fragment"""
+    return {
+        "running": order_reconciliation.running,
+        "report": order_reconciliation.last_report
+    }
+
+@app.get("/api/admin/telegram-sessions")
+async def telegram_sessions_stats(check: bool = False):
+    """Состояние пула сессий Pyrogram: вызовы и FloodWait по сессиям.
+
+    ?check=true — дополнительно выполнить get_me через пул.
+    """
+    result = {"success": True}
+    if check:
+        try:
+            me = await ensure_telegram_connection()
+            result["me"] = me.username or str(me.id)
+        except Exception as e:
+            result["success"] = False
+            result["error"] = str(e)
+    result["sessions"] = telegram_clients.stats()
+    return result
+
+@app.get("/api/admin/broadcasts/{broadcast_id}")
+async def get_broadcast_status(
+    broadcast_id: str,
+    storage: Storage = Depends(get_storage)
+):
+    """Прогресс рассылки"""
+    broadcast = await storage.get_broadcast(broadcast_id)
+    if not broadcast:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+
+    return {
+        "id": broadcast.id,
+        "status": broadcast.status,
+        "running": broadcast_engine.is_running(broadcast.id),
+        "sent": broadcast.sent,
+        "failed": broadcast.failed,
+        "blocked": broadcast.blocked,
+        "cursor": broadcast.cursor,
+        "created_at": broadcast.created_at.isoformat() if broadcast.created_at else None,
+        "updated_at": broadcast.updated_at.isoformat() if broadcast.updated_at else None,
+        "finished_at": broadcast.finished_at.isoformat() if broadcast.finished_at else None,
+        "retry_after_events": broadcast_engine.retry_after_events,
+    }
+
 @app.post("/api/admin/update-ton-price")
 async def force_update_ton_price(storage: Storage = Depends(get_storage)):
     """Принудительно обновить цену TON"""
@@ -1957,9 +2097,105 @@ async def refresh_profit_stats(storage: Storage = Depends(get_storage)):
 # Функция уведомлений (заглушка)
 async def notify_users_new_task(task):
     """Уведомление пользователей о новом задании"""
-    # TODO: реализовать уведомления через Telegram бота
-    logger.info(f"New task created: {task.title}")
-    pass
+    # Рассылка идет на всю базу, поэтому включается явно
+    if os.getenv("NEW_TASK_BROADCAST", "0") != "1":
+        return None
+
+    from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+    text = f"🆕 Новое задание: {task.title}\n\n{task.description}\n\n🎁 Награда: {task.reward} ⭐"
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(
+            text="🚀 Открыть приложение",
+            web_app=WebAppInfo(url=os.getenv("WEBAPP_URL", "https://app1.hezh-digital.ru"))
+        )
+    ]])
+    return await broadcast_engine.start(text, reply_markup)
+
+
+# Prometheus: метрики, которые модули считают сами, собираются при запросе
+def _collect_cache_ratios():
+    avatar = avatar_cache.stats()
+    caches = {
+        "avatar": (avatar["hits"] + avatar["negative_hits"] + avatar["coalesced"], avatar["misses"]),
+    }
+    if bot_webhook_enabled():
+        from bot import storage as fsm_storage
+        if hasattr(fsm_storage, "hits"):
+            caches["fsm"] = (fsm_storage.hits, fsm_storage.misses)
+    for cache, (hits, misses) in caches.items():
+        if hits + misses:
+            yield ("cache_hit_ratio", "gauge", "Share of cache lookups served from memory",
+                   {"cache": cache}, round(hits / (hits + misses), 4))
+
+
+def _collect_fragment():
+    client = getattr(app.state, "fragment_api_client", None)
+    if client is None:
+        return
+    fragment = client.metrics()
+    yield "fragment_in_flight", "gauge", "Fragment API calls in progress", {}, fragment["in_flight"]
+    yield ("fragment_circuit_open", "gauge", "1 if the Fragment circuit breaker is not closed", {},
+           0 if fragment["circuit_breaker"]["state"] == "closed" else 1)
+    for endpoint, stats in fragment["endpoints"].items():
+        for field in ("calls", "errors", "retries", "rejected"):
+            yield (f"fragment_{field}_total", "counter", f"Fragment API {field} by endpoint",
+                   {"endpoint": endpoint}, stats[field])
+
+
+def _collect_bot_updates():
+    if not bot_webhook_enabled():
+        return
+    from bot import update_workers
+    stats = update_workers.stats()
+    yield "bot_update_queue_depth", "gauge", "Bot updates waiting for a worker", {}, stats["queue_depth"]
+    yield "bot_updates_processed_total", "counter", "Bot updates handled", {}, stats["processed"]
+    yield "bot_update_errors_total", "counter", "Bot updates whose handler failed", {}, stats["errors"]
+
+
+instrument_engine(engine)
+for collector in (_collect_cache_ratios, _collect_fragment, _collect_bot_updates):
+    metrics_registry.add_collector(collector)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в формате Prometheus (nginx наружу не проксирует)"""
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Telegram bot в webhook-режиме (вместо отдельного процесса bot.py с polling)
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+
+
+def bot_webhook_enabled() -> bool:
+    return bool(BOT_WEBHOOK_URL and BOT_WEBHOOK_SECRET)
+
+
+@app.post("/api/bot/webhook")
+async def telegram_bot_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+):
+    """Обновления Telegram для бота"""
+    if not bot_webhook_enabled():
+        raise HTTPException(status_code=404, detail="Not found")
+    if not hmac.compare_digest(x_telegram_bot_api_secret_token or "", BOT_WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    from bot import feed_webhook_update
+    await feed_webhook_update(await request.json())
+    return {"ok": True}
+
+
+@app.get("/api/admin/bot-updates")
+async def bot_update_workers_stats():
+    """Очереди и задержки обработчиков бота (webhook-режим)"""
+    if not bot_webhook_enabled():
+        return {"success": True, "enabled": False}
+    from bot import update_workers
+    return {"success": True, "enabled": True, **update_workers.stats()}
 
 
 # Static files for production
@@ -1983,10 +2219,19 @@ async def startup_event():
     
     logger.info(f"FRAGMENT_SEED length: {len(fragment_seed) if fragment_seed else 'None'}")
     logger.info(f"FRAGMENT_COOKIE length: {len(fragment_cookies) if fragment_cookies else 'None'}")
+
+    # Общий пул HTTP-соединений для внешних интеграций
+    app.state.http_clients = HTTPClientRegistry()
+    ton_price_service.http_clients = app.state.http_clients
+    freekassa = get_freekassa()
+    if freekassa:
+        freekassa.http_clients = app.state.http_clients
+    
     try:
         logger.info("🚀 Initializing TON Price Service...")
         async with AsyncSessionLocal() as session:
             storage = Storage(session)
+            await ton_price_service.load_history(storage)
             initial_price = await ton_price_service.get_current_ton_price_rub(storage)
             logger.info(f"✅ TON Price Service initialized with price: {initial_price:.2f} RUB")
     except Exception as e:
@@ -2002,12 +2247,17 @@ async def startup_event():
             logger.info("Creating Fragment API client...")
             app.state.fragment_api_client = AsyncFragmentAPIClient(
                 seed=fragment_seed,
-                fragment_cookies=fragment_cookies
+                fragment_cookies=fragment_cookies,
+                http_client=app.state.http_clients.get_client(FRAGMENT_API_URL, timeout=FRAGMENT_TIMEOUT)
             )
             logger.info("Fragment API client initialized successfully")
               
             balance = await app.state.fragment_api_client.get_balance()
             logger.info(f"Fragment API balance: {balance}")
+            
+            # Автоматическая доставка оплаченных звезд получателям
+            if os.getenv("FRAGMENT_AUTO_DELIVERY", "1") == "1":
+                fragment_fulfilment.start(app.state.fragment_api_client)
         else:
             logger.warning("Fragment API credentials not found, client not initialized")
             app.state.fragment_api_client = None
@@ -2015,6 +2265,22 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Failed to initialize Fragment API client: {e}", exc_info=True)
         app.state.fragment_api_client = None
+    # Фоновая сверка pending-платежей FreeKassa и обработка outbox webhook'ов
+    payment_reconciler.start()
+    payment_event_worker.start()
+    if bot_webhook_enabled():
+        try:
+            from bot import setup_webhook
+            await setup_webhook(BOT_WEBHOOK_URL, BOT_WEBHOOK_SECRET)
+        except Exception as e:
+            logger.error(f"Failed to set bot webhook: {e}")
+    elif BOT_WEBHOOK_URL:
+        logger.error("BOT_WEBHOOK_SECRET is required for webhook mode, webhook disabled")
+    # Рассылки, прерванные перезапуском
+    try:
+        await broadcast_engine.resume()
+    except Exception as e:
+        logger.error(f"Failed to resume broadcasts: {e}")
     # from bot import main as bot_main
     # # Запуск бота в фоновом режиме
     # await bot_main()
@@ -2022,6 +2288,15 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await payment_reconciler.stop()
+    await payment_event_worker.stop()
+    await fragment_fulfilment.stop()
+    await telegram_clients.stop()
+    await broadcast_engine.stop()
+    if bot_webhook_enabled():
+        from bot import close_webhook
+        await close_webhook()
+    
     # Правильное закрытие Fragment API клиента
     if hasattr(app.state, 'fragment_api_client') and app.state.fragment_api_client:
         try:
@@ -2030,6 +2305,18 @@ async def shutdown_event():
         except Exception as e:
             logger.error(f"Error closing Fragment API client: {e}")
     
+    # Дописываем накопленную историю цены TON
+    try:
+        async with AsyncSessionLocal() as session:
+            await ton_price_service.flush_history(Storage(session))
+    except Exception as e:
+        logger.error(f"Error flushing TON price history: {e}")
+
+    # Закрываем общий пул HTTP-соединений
+    if hasattr(app.state, 'http_clients'):
+        await app.state.http_clients.close()
+        logger.info("HTTP client pool closed")
+
     # Close database session
     try:
         await AsyncSessionLocal().close()
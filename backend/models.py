@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Numeric, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, String, Integer, Numeric, Boolean, DateTime, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -55,6 +55,20 @@ class Transaction(Base):
     invoice_id = Column(String, nullable=True, unique=True)  # ID в платежной системе
     payment_data = Column(Text, nullable=True)  # JSON данные от платежной системы
     
+    # Автоматическая доставка звезд через Fragment (fulfilment.py)
+    delivery_status = Column(String, nullable=True)  # None, 'pending', 'processing', 'delivered', 'failed'
+    delivery_attempts = Column(Integer, default=0)
+    delivery_started_at = Column(DateTime, nullable=True)  # Начало последней попытки
+    delivery_next_attempt_at = Column(DateTime, nullable=True)
+    delivery_data = Column(Text, nullable=True)  # JSON ответа Fragment
+    delivery_error = Column(Text, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    
+    # Сверка с историей заказов Fragment (order_reconciliation.py)
+    reconciliation_status = Column(String, nullable=True)  # 'matched', 'missing', 'duplicate'
+    fragment_order_id = Column(String, nullable=True)
+    reconciled_at = Column(DateTime, nullable=True)
+    
     created_at = Column(DateTime, default=datetime.utcnow)
     paid_at = Column(DateTime, nullable=True)  # Время оплаты
     
@@ -108,4 +122,52 @@ class Setting(Base):
     id = Column(String, primary_key=True, default=generate_uuid)
     key = Column(String, nullable=False, unique=True)
     value = Column(Text, nullable=False)
-    updated_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class PriceHistory(Base):
+    __tablename__ = "price_history"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    price = Column(Numeric(10, 2), nullable=False)  # Цена TON в рублях с наценкой
+    base_price = Column(Numeric(10, 2), nullable=True)  # Биржевая цена без наценки
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class PaymentEvent(Base):
+    __tablename__ = "payment_events"
+    __table_args__ = (UniqueConstraint("provider", "intid", name="uq_payment_events_provider_intid"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    provider = Column(String, nullable=False)  # 'freekassa'
+    intid = Column(String, nullable=False)  # ID операции в платежной системе
+    transaction_id = Column(String, ForeignKey("transactions.id"), nullable=True)
+    amount = Column(Numeric(10, 2), nullable=True)
+    payload = Column(Text, nullable=True)  # JSON webhook'а
+    status = Column(String, default="pending", index=True)  # 'pending', 'processed', 'dead'
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+
+    id = Column(String, primary_key=True, default=generate_uuid)
+    text = Column(Text, nullable=False)
+    reply_markup = Column(Text, nullable=True)  # JSON InlineKeyboardMarkup
+    status = Column(String, default="running")  # 'running', 'completed', 'failed'
+    cursor = Column(String, nullable=True)  # users.id последнего обработанного пользователя
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)  # Пользователь заблокировал бота
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class FSMState(Base):
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)  # Ключ aiogram DefaultKeyBuilder
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)  # Компактный JSON
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import aclosing
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from api import AsyncFragmentAPIClient, order_amount, order_id, order_recipient, parse_order_time
+from database import AsyncSessionLocal
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Сколько id каждого вида попадет в отчет
+REPORT_SAMPLE_SIZE = 50
+
+
+class _Delivery:
+    """Оплаченная транзакция в индексе сверки"""
+    __slots__ = ("id", "paid_at", "delivery_status", "order_ids")
+
+    def __init__(self, transaction_id: str, paid_at: datetime, delivery_status: Optional[str]):
+        self.id = transaction_id
+        self.paid_at = paid_at
+        self.delivery_status = delivery_status
+        self.order_ids: List[Optional[str]] = []
+
+
+class OrderReconciliation:
+    """Сверка оплаченных звезд с историей заказов Fragment.
+
+    Все транзакции периода читаются одним запросом в индекс
+    (получатель, количество) -> транзакции по времени оплаты, затем заказы
+    Fragment проходят потоком через iter_orders. Заказ сопоставляется с
+    ближайшей несопоставленной оплатой не позже него в пределах window.
+    Итог пишется пачками bulk UPDATE: matched / duplicate (больше одного
+    заказа на оплату) / missing (заказа нет спустя grace после оплаты).
+    """
+
+    def __init__(
+        self,
+        window: timedelta = timedelta(hours=24),
+        clock_skew: timedelta = timedelta(minutes=5),
+        grace: timedelta = timedelta(hours=1),
+        page_size: int = 100,
+        update_batch_size: int = 1000,
+    ):
+        self.window = window
+        self.clock_skew = clock_skew
+        self.grace = grace
+        self.page_size = page_size
+        self.update_batch_size = update_batch_size
+        self.last_report: Optional[Dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, client: AsyncFragmentAPIClient, since: datetime) -> bool:
+        """Запустить сверку в фоне; False, если она уже идет"""
+        if self.running:
+            return False
+        self._task = asyncio.create_task(self._run_safe(client, since))
+        return True
+
+    async def _run_safe(self, client: AsyncFragmentAPIClient, since: datetime):
+        try:
+            await self.run(client, since)
+        except Exception as e:
+            logger.error(f"❌ Fragment order reconciliation failed: {e}", exc_info=True)
+            self.last_report = {"success": False, "since": since.isoformat(), "error": str(e)}
+
+    async def run(self, client: AsyncFragmentAPIClient, since: datetime) -> Dict:
+        started = time.perf_counter()
+        started_at = datetime.utcnow()
+
+        async with AsyncSessionLocal() as session:
+            rows = await Storage(session).get_paid_star_deliveries(since)
+
+        index, times = self._build_index(rows)
+
+        orders_scanned = 0
+        unmatched_orders = 0
+        unmatched_sample: List[Optional[str]] = []
+        async with aclosing(client.iter_orders(page_size=self.page_size, since=since - self.clock_skew)) as orders:
+            async for order in orders:
+                orders_scanned += 1
+                if not self._match(index, times, order):
+                    unmatched_orders += 1
+                    if len(unmatched_sample) < REPORT_SAMPLE_SIZE:
+                        unmatched_sample.append(order_id(order))
+
+        report = await self._apply(index, started_at)
+        report.update({
+            "success": True,
+            "since": since.isoformat(),
+            "started_at": started_at.isoformat(),
+            "duration_s": round(time.perf_counter() - started, 2),
+            "transactions": len(rows),
+            "orders_scanned": orders_scanned,
+            "unmatched_orders": unmatched_orders,
+            "unmatched_order_ids": unmatched_sample,
+        })
+        self.last_report = report
+        logger.info(
+            f"🧾 Fragment reconciliation: {report['matched']} matched, {report['missing']} missing, "
+            f"{report['duplicate']} duplicate, {report['unmatched_orders']} unmatched orders"
+        )
+        return report
+
+    @staticmethod
+    def _build_index(rows) -> Tuple[Dict[Tuple[str, int], List[_Delivery]], Dict[Tuple[str, int], List[datetime]]]:
+        index: Dict[Tuple[str, int], List[_Delivery]] = defaultdict(list)
+        for transaction_id, recipient, amount, paid_at, delivery_status in rows:
+            key = (recipient.lstrip("@").lower(), int(amount))
+            index[key].append(_Delivery(transaction_id, paid_at, delivery_status))
+        # Строки уже отсортированы по paid_at; отдельный список времен — для bisect
+        times = {key: [delivery.paid_at for delivery in deliveries] for key, deliveries in index.items()}
+        return index, times
+
+    def _match(self, index, times, order: Dict) -> bool:
+        key = (order_recipient(order), order_amount(order))
+        deliveries = index.get(key)
+        if not deliveries:
+            return False
+
+        ordered_at = parse_order_time(order)
+        if ordered_at is None:
+            # Без времени — самая ранняя несопоставленная оплата
+            candidates = deliveries
+        else:
+            # Оплаты в окне [ordered_at - window, ordered_at + clock_skew], от поздних к ранним
+            upper = bisect_right(times[key], ordered_at + self.clock_skew)
+            lower_bound = ordered_at - self.window
+            candidates = []
+            for delivery in reversed(deliveries[:upper]):
+                if delivery.paid_at < lower_bound:
+                    break
+                candidates.append(delivery)
+            if not candidates:
+                return False
+
+        for delivery in candidates:
+            if not delivery.order_ids:
+                delivery.order_ids.append(order_id(order))
+                return True
+
+        # Все оплаты в окне уже сопоставлены — повторная доставка
+        candidates[0].order_ids.append(order_id(order))
+        return True
+
+    async def _apply(self, index, now: datetime) -> Dict:
+        missing_before = now - self.grace
+        updates: List[Dict] = []
+        summary = {"matched": 0, "duplicate": 0, "missing": 0, "in_progress": 0}
+        missing_ids: List[str] = []
+        duplicate_ids: List[str] = []
+
+        for deliveries in index.values():
+            for delivery in deliveries:
+                if len(delivery.order_ids) == 1:
+                    status = "matched"
+                elif delivery.order_ids:
+                    status = "duplicate"
+                    duplicate_ids.append(delivery.id)
+                elif delivery.paid_at >= missing_before or delivery.delivery_status in ("pending", "processing"):
+                    # Доставка еще может идти
+                    summary["in_progress"] += 1
+                    continue
+                else:
+                    status = "missing"
+                    missing_ids.append(delivery.id)
+                summary[status] += 1
+                updates.append({
+                    "id": delivery.id,
+                    "reconciliation_status": status,
+                    "fragment_order_id": delivery.order_ids[0] if delivery.order_ids else None,
+                    "reconciled_at": now,
+                })
+
+        async with AsyncSessionLocal() as session:
+            storage = Storage(session)
+            for start in range(0, len(updates), self.update_batch_size):
+                await storage.bulk_update_transactions(updates[start:start + self.update_batch_size])
+
+        summary["missing_ids"] = missing_ids[:REPORT_SAMPLE_SIZE]
+        summary["duplicate_ids"] = duplicate_ids[:REPORT_SAMPLE_SIZE]
+        return summary
+
+
+# Глобальный экземпляр
+order_reconciliation = OrderReconciliation()
@@ -0,0 +1,356 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+
+from database import AsyncSessionLocal
+from freekassa import get_freekassa
+from fulfilment import fragment_fulfilment
+from models import Transaction
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+# Статусы, после которых платеж больше не меняется
+FINAL_PAYMENT_STATUSES = ("completed", "failed", "cancelled")
+
+
+class PaymentStatusBroker:
+    """In-process pub/sub изменений статуса платежа по transaction_id"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, transaction_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(transaction_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, transaction_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(transaction_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[transaction_id]
+
+    def publish(self, transaction_id: str, status: str, paid_at: Optional[datetime] = None):
+        event = {
+            "transaction_id": transaction_id,
+            "status": status,
+            "paid_at": paid_at.isoformat() if paid_at else None,
+        }
+        for queue in self._subscribers.get(transaction_id, ()):
+            queue.put_nowait(event)
+
+
+payment_status_broker = PaymentStatusBroker()
+
+
+async def complete_purchase(storage: Storage, transaction: Transaction, payment_data: str) -> bool:
+    """Отметить покупку оплаченной и начислить валюту.
+
+    Общий путь для webhook'а FreeKassa и фоновой сверки. Начисление
+    выполняет только тот вызов, который перевел транзакцию из pending
+    в completed; для остальных возвращает False.
+    """
+    if transaction.status != "pending":
+        return False
+
+    paid_at = datetime.utcnow()
+    updates = {"paid_at": paid_at, "payment_data": payment_data}
+    # Звезды для получателя доставляет очередь fulfilment через Fragment
+    deliver = transaction.currency == "stars" and bool(transaction.recipient_username)
+    if deliver:
+        updates["delivery_status"] = "pending"
+    # Перевод в completed и начисление фиксируются одним commit
+    try:
+        if not await storage.complete_pending_transaction(transaction.id, updates):
+            await storage.db.rollback()
+            return False
+
+        # Начислить валюту пользователю
+        if transaction.currency == "ton":
+            await storage.increment_user_balances(transaction.user_id, ton_balance=transaction.amount)
+        elif transaction.currency == "stars":
+            stars = int(transaction.amount)
+            await storage.increment_user_balances(
+                transaction.user_id, stars_balance=stars, total_stars_earned=stars
+            )
+
+        # Обработать реферальный бонус
+        user = await storage.get_user(transaction.user_id)
+        if user and user.referred_by:
+            bonus_amount = int(float(transaction.amount) * 0.1)  # 10% бонус
+            await storage.process_referral_bonus(user.referred_by, bonus_amount, commit=False)
+
+        await storage.db.commit()
+    except Exception:
+        await storage.db.rollback()
+        raise
+
+    # Логирование с получателем
+    log_msg = f"FreeKassa transaction {transaction.id} completed successfully"
+    if transaction.recipient_username:
+        log_msg += f" (recipient: @{transaction.recipient_username})"
+    logger.info(log_msg)
+
+    # Уведомить подписчиков (SSE Mini App) сразу после начисления
+    payment_status_broker.publish(transaction.id, "completed", paid_at)
+    if deliver:
+        fragment_fulfilment.notify()
+    return True
+
+
+class PaymentReconciler:
+    """Фоновая сверка pending-платежей FreeKassa.
+
+    Раз в interval секунд берет свежие pending-транзакции, опрашивает
+    их статусы в FreeKassa не более чем concurrency запросами одновременно
+    и завершает оплаченные через complete_purchase. Чем старше счет, тем
+    реже он опрашивается: не чаще раза в backoff_ratio от его возраста,
+    так брошенная оплата не расходует лимит запросов FreeKassa.
+    """
+
+    def __init__(
+        self,
+        interval: Optional[float] = None,
+        concurrency: int = 5,
+        max_age: timedelta = timedelta(hours=3),
+        batch_size: int = 200,
+        backoff_ratio: float = 0.1,
+    ):
+        self.interval = interval or float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "30"))
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.backoff_ratio = backoff_ratio
+        self._checked_at: Dict[str, datetime] = {}  # transaction_id -> время последнего опроса
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"💳 Payment reconciler started (every {self.interval:.0f}s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                logger.error(f"❌ Payment reconciliation failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def _is_due(self, transaction_id: str, created_at: datetime, now: datetime) -> bool:
+        """Пора ли снова опрашивать счет: интервал растет с его возрастом"""
+        checked_at = self._checked_at.get(transaction_id)
+        if checked_at is None:
+            return True
+        age = (now - created_at).total_seconds()
+        return (now - checked_at).total_seconds() >= max(self.interval, age * self.backoff_ratio)
+
+    async def reconcile_once(self) -> Dict[str, int]:
+        """Один проход сверки"""
+        result = {"checked": 0, "completed": 0, "cancelled": 0}
+
+        freekassa = get_freekassa()
+        if not freekassa or not freekassa.api_key:
+            return result
+
+        async with AsyncSessionLocal() as session:
+            pending = await Storage(session).get_pending_transactions(
+                "freekassa", datetime.utcnow() - self.max_age, self.batch_size
+            )
+            # Копии полей: ORM-объекты не переживают закрытие сессии
+            pending = [(t.id, t.invoice_id, t.created_at) for t in pending]
+
+        now = datetime.utcnow()
+        # Забываем транзакции, которые вышли из pending или из окна max_age
+        self._checked_at = {
+            transaction_id: self._checked_at[transaction_id]
+            for transaction_id, _, _ in pending if transaction_id in self._checked_at
+        }
+        pending = [
+            (transaction_id, invoice_id) for transaction_id, invoice_id, created_at in pending
+            if self._is_due(transaction_id, created_at, now)
+        ]
+        if not pending:
+            return result
+        for transaction_id, _ in pending:
+            self._checked_at[transaction_id] = now
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(transaction_id: str, invoice_id: str):
+            async with semaphore:
+                return transaction_id, await freekassa.check_payment_status(invoice_id)
+
+        # Внешние запросы параллельно, запись в БД — последовательно
+        statuses = await asyncio.gather(*(check(*snapshot) for snapshot in pending))
+        result["checked"] = len(statuses)
+
+        for transaction_id, payment_status in statuses:
+            if not payment_status:
+                continue
+            # Своя сессия на каждую транзакцию: rollback проигравшего гонку
+            # с webhook'ом complete_purchase не задевает остальную пачку
+            async with AsyncSessionLocal() as session:
+                storage = Storage(session)
+                if payment_status['status'] == 'paid':
+                    transaction = await storage.get_transaction(transaction_id)
+                    if transaction and await complete_purchase(
+                        storage, transaction, json.dumps(payment_status['response'])
+                    ):
+                        result["completed"] += 1
+                elif payment_status['status'] == 'cancelled':
+                    if await storage.cancel_pending_transaction(transaction_id):
+                        payment_status_broker.publish(transaction_id, "cancelled")
+                        result["cancelled"] += 1
+
+        if result["completed"] or result["cancelled"]:
+            logger.info(f"💳 Payment reconciliation: {result}")
+        return result
+
+
+class PaymentEventRejected(Exception):
+    """Событие платежа, которое бессмысленно повторять (сразу в dead)"""
+    pass
+
+
+class PaymentEventWorker:
+    """Обработчик outbox payment_events.
+
+    Webhook только проверяет подпись, записывает событие и сразу отвечает
+    YES. Начисление и реферальный бонус выполняются здесь пачками, с
+    повторами по экспоненциальному backoff; после max_attempts неудач
+    событие переходит в статус dead и ждет ручного разбора.
+    """
+
+    def __init__(
+        self,
+        poll_interval: float = 5.0,
+        batch_size: int = 50,
+        max_attempts: int = 8,
+        base_backoff: float = 10.0,
+        max_backoff: float = 30 * 60,
+    ):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("📬 Payment event worker started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """Разбудить воркер сразу после записи нового события"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                logger.error(f"❌ Payment event batch failed: {e}", exc_info=True)
+                processed = 0
+
+            # Полная пачка — вероятно, есть еще, не ждем
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self) -> int:
+        """Обработать одну пачку готовых событий, вернуть их количество"""
+        async with AsyncSessionLocal() as session:
+            storage = Storage(session)
+            events = await storage.get_due_payment_events(datetime.utcnow(), self.batch_size)
+            # rollback после ошибки экспирит ORM-объекты сессии, поэтому работаем с копиями полей
+            snapshots = [
+                (event.id, event.intid, event.attempts or 0, event.amount, event.payload)
+                for event in events
+            ]
+            for snapshot in snapshots:
+                await self._process_event(storage, *snapshot)
+            return len(snapshots)
+
+    async def _process_event(self, storage: Storage, event_id: int, intid: str, attempts: int, amount, payload: str):
+        attempts += 1
+        try:
+            transaction_id = await self._apply(storage, amount, payload)
+        except Exception as e:
+            await storage.db.rollback()
+            updates = {"attempts": attempts, "last_error": str(e)[:1000]}
+            if isinstance(e, PaymentEventRejected) or attempts >= self.max_attempts:
+                updates["status"] = "dead"
+                logger.error(f"💀 Payment event {intid} moved to dead letter: {e}")
+            else:
+                delay = min(self.base_backoff * 2 ** (attempts - 1), self.max_backoff)
+                updates["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=delay)
+                logger.warning(f"⚠️ Payment event {intid} failed (attempt {attempts}), retry in {delay:.0f}s: {e}")
+            await storage.update_payment_event(event_id, updates)
+            return
+
+        await storage.update_payment_event(event_id, {
+            "status": "processed",
+            "attempts": attempts,
+            "transaction_id": transaction_id,
+            "last_error": None,
+            "processed_at": datetime.utcnow()
+        })
+
+    async def _apply(self, storage: Storage, amount, payload: str) -> str:
+        data = json.loads(payload or "{}")
+        order_id = data.get("MERCHANT_ORDER_ID", "")
+
+        # MERCHANT_ORDER_ID — это invoice_id из платежной ссылки
+        transaction = (
+            await storage.get_transaction_by_invoice_id(order_id)
+            or await storage.get_transaction(order_id)
+        )
+        if not transaction:
+            raise LookupError(f"Transaction not found: {order_id}")
+
+        expected_amount = float(transaction.rub_amount or 0)
+        received_amount = float(amount or 0)
+        if abs(expected_amount - received_amount) > 0.01:  # Допуск 1 копейка
+            raise PaymentEventRejected(f"Amount mismatch: expected {expected_amount}, received {received_amount}")
+
+        await complete_purchase(storage, transaction, payload)
+        return transaction.id
+
+
+# Глобальные экземпляры
+payment_reconciler = PaymentReconciler()
+payment_event_worker = PaymentEventWorker()
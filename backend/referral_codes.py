@@ -0,0 +1,59 @@
+import hashlib
+import hmac
+import os
+from typing import Optional
+
+# Telegram user id укладывается в 52 бита
+ID_BITS = 52
+HALF_BITS = ID_BITS // 2
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# 36^11 > 2^52
+CODE_LENGTH = 11
+
+
+_key: Optional[bytes] = None
+
+
+def _get_key() -> bytes:
+    """Ключ читается при первом использовании, когда .env уже загружен"""
+    global _key
+    if _key is None:
+        secret = os.getenv("REFERRAL_CODE_SECRET") or os.getenv("BOT_TOKEN")
+        if not secret:
+            raise RuntimeError("REFERRAL_CODE_SECRET (or BOT_TOKEN) must be set to generate referral codes")
+        _key = secret.encode("utf-8")
+    return _key
+
+
+def _round(key: bytes, value: int, round_number: int) -> int:
+    digest = hmac.new(key, f"{round_number}:{value}".encode("ascii"), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], "big") & HALF_MASK
+
+
+def _permute(number: int) -> int:
+    """Сбалансированная сеть Фейстеля — биекция на [0, 2^52)"""
+    key = _get_key()
+    left, right = number >> HALF_BITS, number & HALF_MASK
+    for round_number in range(ROUNDS):
+        left, right = right, left ^ _round(key, right, round_number)
+    return (left << HALF_BITS) | right
+
+
+def referral_code_for(telegram_id) -> str:
+    """Реферальный код пользователя: ключевая перестановка telegram_id в base36.
+
+    Разные telegram_id всегда дают разные коды, поэтому проверять код в БД
+    не нужно; без ключа код нельзя ни угадать, ни перебрать по соседям.
+    """
+    number = int(telegram_id)
+    if number < 0 or number >> ID_BITS:
+        raise ValueError(f"telegram_id out of range: {telegram_id}")
+
+    value = _permute(number)
+    chars = []
+    for _ in range(CODE_LENGTH):
+        value, digit = divmod(value, 36)
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
@@ -1,14 +1,21 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, and_, func
+from sqlalchemy import select, update, insert, and_, or_, func
 from sqlalchemy.orm import selectinload
-from models import User, Transaction, Task, UserTask, Setting
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import User, Transaction, Task, UserTask, Setting, PriceHistory, PaymentEvent, Broadcast
+from metrics import cache_requests_total
+from referral_codes import referral_code_for
 from schemas import UserCreate, TransactionCreate, UserTaskCreate, SettingCreate
-from typing import Optional, List
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
 from datetime import datetime
+import logging
 import random
 import string
 from cachetools import TTLCache
 
+logger = logging.getLogger(__name__)
+
 class Storage:
     def __init__(self, db: AsyncSession):
         self.db = db
@@ -33,70 +40,70 @@ class Storage:
     async def get_user_referrals(self, user_id: str) -> List[User]:
         """Получить всех рефералов конкретного пользователя"""
         try:
-            import logging
-            logger = logging.getLogger(__name__)
-            
-            logger.info(f"🔍 Getting referrals for user_id: {user_id}")
-            logger.info(f"🔍 user_id type: {type(user_id)}")
-            
-            # Сначала проверим, есть ли пользователи с заполненным referred_by вообще
-            all_users_query = select(User).where(User.referred_by.isnot(None))
-            all_with_referrer = await self.db.execute(all_users_query)
-            all_referred_users = all_with_referrer.scalars().all()
-            
-            logger.info(f"🔍 Total users with referrer in DB: {len(all_referred_users)}")
-            for user in all_referred_users:
-                logger.info(f"  - User {user.id} (telegram: {user.telegram_id}) referred by: {user.referred_by}")
-            
-            # Теперь ищем конкретных рефералов
-            query = select(User).where(User.referred_by == user_id)
-            logger.info(f"🔍 Executing query: {query}")
-            
-            result = await self.db.execute(query)
+            result = await self.db.execute(select(User).where(User.referred_by == user_id))
             referrals = result.scalars().all()
-            
-            logger.info(f"🔍 Found {len(referrals)} referrals for user {user_id}")
-            
-            if referrals:
-                logger.info(f"🔍 Referral details:")
-                for ref in referrals:
-                    logger.info(f"  - ID: {ref.id}, telegram_id: {ref.telegram_id}, username: {ref.username}")
-            else:
-                logger.warning(f"🔍 No referrals found for user_id: {user_id}")
-                
+            logger.debug("Found %d referrals for user %s", len(referrals), user_id)
             return referrals
-            
         except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
             logger.error(f"❌ Error in get_user_referrals: {e}", exc_info=True)
             return []
-        
+
+    @staticmethod
+    def _new_referral_code(telegram_id: Optional[str] = None) -> str:
+        """Код из telegram_id (без коллизий), иначе случайный"""
+        if telegram_id is not None:
+            try:
+                return referral_code_for(telegram_id)
+            except ValueError:
+                pass
+        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+
     async def create_user(self, user_data: UserCreate) -> User:
-        # Генерируем уникальный код (до 10 попыток)
-        for _ in range(10):
-            referral_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-            if not await self.get_user_by_referral_code(referral_code):
-                break
-        else:
-            # Fallback на UUID если не получилось
-            import uuid
-            referral_code = str(uuid.uuid4())[:10].upper()
-        
-        user = User(
-            telegram_id=user_data.telegram_id,
-            username=user_data.username,
-            first_name=user_data.first_name,
-            last_name=user_data.last_name,
-            referral_code=referral_code,
-            referred_by=user_data.referred_by
-        )
-        
-        self.db.add(user)
-        await self.db.commit()
-        await self.db.refresh(user)
+        user, _ = await self.get_or_create_user(user_data)
         return user
 
+    async def get_or_create_user(self, user_data: UserCreate,
+                                 referral_code: Optional[str] = None) -> Tuple[User, bool]:
+        """Создать пользователя или вернуть существующего: (user, created).
+
+        Один INSERT ... ON CONFLICT(telegram_id) DO NOTHING RETURNING, реферер по
+        referral_code находится подзапросом в том же запросе. Для уже
+        существующего пользователя — еще один SELECT.
+        """
+        referred_by = user_data.referred_by
+        if referral_code:
+            referred_by = select(User.id).where(User.referral_code == referral_code).scalar_subquery()
+
+        for attempt in range(2):
+            statement = (
+                sqlite_insert(User)
+                .values(
+                    telegram_id=user_data.telegram_id,
+                    username=user_data.username,
+                    first_name=user_data.first_name,
+                    last_name=user_data.last_name,
+                    # Повтор — только при совпадении с кодом, выданным под другим ключом
+                    referral_code=self._new_referral_code(None if attempt else user_data.telegram_id),
+                    referred_by=referred_by
+                )
+                .on_conflict_do_nothing(index_elements=[User.telegram_id])
+                .returning(User)
+            )
+            try:
+                result = await self.db.execute(statement)
+                user = result.scalar_one_or_none()
+                await self.db.commit()
+                break
+            except IntegrityError:
+                # Совпал referral_code — пробуем случайный
+                await self.db.rollback()
+                if attempt:
+                    raise
+
+        if user is not None:
+            return user, True
+        return await self.get_user_by_telegram_id(user_data.telegram_id), False
+
     async def update_user(self, user_id: str, updates: dict) -> Optional[User]:
         await self.db.execute(
             update(User).where(User.id == user_id).values(**updates)
@@ -105,29 +112,48 @@ class Storage:
         return await self.get_user(user_id)
 
     async def get_all_users(self) -> List[User]:
-        """Получить всех пользователей из базы данных"""
-        try:
-            result = await self.db.execute(select(User))
-            users = result.scalars().all()
-            
-            # Убедимся, что возвращаем список объектов User
-            # Проверяем, что каждый элемент - это объект User
-            validated_users = []
-            for user in users:
-                if isinstance(user, User):
-                    validated_users.append(user)
-                else:
-                    # Если по какой-то причине получили не объект User, логируем
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.warning(f"Unexpected type in get_all_users: {type(user)}")
-            
-            return validated_users
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f"Error in get_all_users: {e}", exc_info=True)
-            raise
+        """Получить всех пользователей из базы данных (для больших выборок — iter_users)"""
+        result = await self.db.execute(select(User))
+        return result.scalars().all()
+
+    async def iter_users(
+        self,
+        filter=None,
+        batch_size: int = 1000,
+        columns: Optional[Sequence[str]] = None,
+        after_id: Optional[str] = None,
+    ) -> AsyncIterator:
+        """Пользователи порциями по users.id (keyset), в памяти не больше batch_size.
+
+        filter — условие SQLAlchemy (например User.notifications_enabled.is_(True)).
+        columns — имена полей: тогда вместо объектов User отдаются строки только
+        с этими полями (id добавляется всегда). after_id — продолжить после него.
+        После каждой порции читающая транзакция завершается, чтобы не держать
+        блокировку БД, пока вызывающий код обрабатывает порцию.
+        """
+        if columns:
+            names = ["id"] + [name for name in columns if name != "id"]
+            query = select(*(getattr(User, name) for name in names))
+        else:
+            query = select(User)
+        if filter is not None:
+            query = query.where(filter)
+
+        while True:
+            batch_query = query
+            if after_id is not None:
+                batch_query = batch_query.where(User.id > after_id)
+            result = await self.db.execute(batch_query.order_by(User.id).limit(batch_size))
+            batch = result.all() if columns else result.scalars().all()
+            await self.db.commit()
+            if not batch:
+                return
+
+            for item in batch:
+                yield item
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1].id
 
     # Transaction methods
     async def get_transaction(self, transaction_id: str) -> Optional[Transaction]:
@@ -136,6 +162,27 @@ class Storage:
         )
         return result.scalar_one_or_none()
 
+    async def get_transaction_by_invoice_id(self, invoice_id: str) -> Optional[Transaction]:
+        result = await self.db.execute(
+            select(Transaction).where(Transaction.invoice_id == invoice_id)
+        )
+        return result.scalar_one_or_none()
+
+    async def get_pending_transactions(self, payment_system: str, created_after: datetime, limit: int = 100) -> List[Transaction]:
+        """Pending-транзакции платежной системы, созданные после created_after"""
+        result = await self.db.execute(
+            select(Transaction)
+            .where(and_(
+                Transaction.status == "pending",
+                Transaction.payment_system == payment_system,
+                Transaction.invoice_id.isnot(None),
+                Transaction.created_at >= created_after
+            ))
+            .order_by(Transaction.created_at.desc())
+            .limit(limit)
+        )
+        return result.scalars().all()
+
     async def get_transactions_by_user_id(self, user_id: str) -> List[Transaction]:
         result = await self.db.execute(
             select(Transaction).where(Transaction.user_id == user_id)
@@ -149,6 +196,134 @@ class Storage:
         await self.db.refresh(transaction)
         return transaction
 
+    async def complete_pending_transaction(self, transaction_id: str, updates: dict) -> bool:
+        """Атомарный переход pending -> completed без commit.
+
+        True только для того вызова, чей UPDATE изменил строку: параллельные
+        webhook и сверка не могут начислить одну покупку дважды. Фиксирует
+        изменения вызывающий код вместе с начислением.
+        """
+        result = await self.db.execute(
+            update(Transaction)
+            .where(and_(Transaction.id == transaction_id, Transaction.status == "pending"))
+            .values(status="completed", **updates)
+        )
+        return result.rowcount == 1
+
+    async def cancel_pending_transaction(self, transaction_id: str) -> bool:
+        """Атомарный переход pending -> cancelled: уже завершенную не трогает"""
+        result = await self.db.execute(
+            update(Transaction)
+            .where(and_(Transaction.id == transaction_id, Transaction.status == "pending"))
+            .values(status="cancelled")
+        )
+        await self.db.commit()
+        return result.rowcount == 1
+
+    async def increment_user_balances(self, user_id: str, **deltas):
+        """Прибавить к полям пользователя в SQL, без commit"""
+        await self.db.execute(
+            update(User).where(User.id == user_id).values(**{
+                name: func.coalesce(getattr(User, name), 0) + delta for name, delta in deltas.items()
+            })
+        )
+
+    async def get_due_deliveries(self, now: datetime, limit: int = 20) -> List[Transaction]:
+        """Оплаченные транзакции, ожидающие доставки через Fragment"""
+        result = await self.db.execute(
+            select(Transaction)
+            .where(and_(
+                Transaction.status == "completed",
+                Transaction.delivery_status == "pending",
+                or_(Transaction.delivery_next_attempt_at.is_(None), Transaction.delivery_next_attempt_at <= now)
+            ))
+            .order_by(Transaction.paid_at)
+            .limit(limit)
+        )
+        return result.scalars().all()
+
+    async def claim_delivery(self, transaction_id: str) -> bool:
+        """Атомарно взять доставку в работу (pending -> processing)"""
+        result = await self.db.execute(
+            update(Transaction)
+            .where(and_(Transaction.id == transaction_id, Transaction.delivery_status == "pending"))
+            .values(
+                delivery_status="processing",
+                delivery_attempts=func.coalesce(Transaction.delivery_attempts, 0) + 1,
+                delivery_started_at=datetime.utcnow()
+            )
+        )
+        await self.db.commit()
+        return result.rowcount == 1
+
+    async def reset_stale_deliveries(self) -> int:
+        """Вернуть в очередь доставки, прерванные перезапуском (processing -> pending)"""
+        result = await self.db.execute(
+            update(Transaction)
+            .where(Transaction.delivery_status == "processing")
+            .values(delivery_status="pending", delivery_next_attempt_at=None)
+        )
+        await self.db.commit()
+        return result.rowcount
+
+    async def get_claimed_fragment_order_ids(self, order_ids: List[str]) -> set:
+        """Какие из заказов Fragment уже записаны за транзакциями"""
+        if not order_ids:
+            return set()
+        result = await self.db.execute(
+            select(Transaction.fragment_order_id).where(Transaction.fragment_order_id.in_(order_ids))
+        )
+        return set(result.scalars().all())
+
+    async def has_concurrent_delivery(self, transaction_id: str, username: str, amount: int) -> bool:
+        """Идет ли сейчас другая доставка того же количества тому же получателю"""
+        result = await self.db.execute(
+            select(Transaction.recipient_username)
+            .where(and_(
+                Transaction.delivery_status == "processing",
+                Transaction.amount == amount,
+                Transaction.id != transaction_id
+            ))
+        )
+        username = username.lstrip("@").lower()
+        return any((recipient or "").lstrip("@").lower() == username for recipient in result.scalars().all())
+
+    async def get_delivery_counts(self) -> dict:
+        """Количество доставок по статусам"""
+        result = await self.db.execute(
+            select(Transaction.delivery_status, func.count(Transaction.id))
+            .where(Transaction.delivery_status.isnot(None))
+            .group_by(Transaction.delivery_status)
+        )
+        return {status: count for status, count in result.all()}
+
+    async def get_paid_star_deliveries(self, since: datetime) -> List[tuple]:
+        """(id, recipient_username, amount, paid_at, delivery_status) оплаченных звезд для получателей"""
+        result = await self.db.execute(
+            select(
+                Transaction.id,
+                Transaction.recipient_username,
+                Transaction.amount,
+                Transaction.paid_at,
+                Transaction.delivery_status
+            )
+            .where(and_(
+                Transaction.status == "completed",
+                Transaction.currency == "stars",
+                Transaction.recipient_username.isnot(None),
+                Transaction.paid_at >= since
+            ))
+            .order_by(Transaction.paid_at)
+        )
+        return result.all()
+
+    async def bulk_update_transactions(self, rows: List[dict]):
+        """Обновить много транзакций одним executemany; в каждой строке обязателен id"""
+        if not rows:
+            return
+        await self.db.execute(update(Transaction), rows)
+        await self.db.commit()
+
     async def update_transaction(self, transaction_id: str, updates: dict) -> Optional[Transaction]:
         await self.db.execute(
             update(Transaction).where(Transaction.id == transaction_id).values(**updates)
@@ -321,37 +496,43 @@ class Storage:
         except Exception as e:
             return None
 
-    async def process_referral_bonus(self, referrer_user_id: str, bonus_amount: int):
-        """Начислить реферальный бонус за покупку друга"""
+    async def process_referral_bonus(self, referrer_user_id: str, bonus_amount: int, commit: bool = True):
+        """Начислить реферальный бонус за покупку друга.
+
+        commit=False — только записать изменения в текущую транзакцию сессии.
+        """
+        if not commit:
+            await self._add_referral_bonus(referrer_user_id, bonus_amount)
+            return
         try:
-            referrer = await self.get_user(referrer_user_id)
-            if not referrer:
-                return
-            
-            # Начисляем бонус
-            updates = {
-                "stars_balance": referrer.stars_balance + bonus_amount,
-                "total_referral_earnings": referrer.total_referral_earnings + bonus_amount,
-                "total_stars_earned": referrer.total_stars_earned + bonus_amount
-            }
-            
-            await self.update_user(referrer_user_id, updates)
-            from decimal import Decimal; 
-            # Создаем транзакцию для истории
-            from schemas import TransactionCreate
-            transaction_data = TransactionCreate(
-                user_id=referrer_user_id,
-                type="referral_bonus",
-                currency="stars",
-                amount=Decimal(str(bonus_amount)),
-                status="completed",
-                description=f"Реферальный бонус: {bonus_amount} звезд с покупки друга"
-            )
-            await self.create_transaction(transaction_data)
-            
-            
+            if await self._add_referral_bonus(referrer_user_id, bonus_amount):
+                await self.db.commit()
         except Exception as e:
-            None
+            await self.db.rollback()
+
+    async def _add_referral_bonus(self, referrer_user_id: str, bonus_amount: int) -> bool:
+        referrer = await self.get_user(referrer_user_id)
+        if not referrer:
+            return False
+
+        # Начисляем бонус
+        await self.increment_user_balances(
+            referrer_user_id,
+            stars_balance=bonus_amount,
+            total_referral_earnings=bonus_amount,
+            total_stars_earned=bonus_amount
+        )
+        from decimal import Decimal
+        # Создаем транзакцию для истории
+        self.db.add(Transaction(
+            user_id=referrer_user_id,
+            type="referral_bonus",
+            currency="stars",
+            amount=Decimal(str(bonus_amount)),
+            status="completed",
+            description=f"Реферальный бонус: {bonus_amount} звезд с покупки друга"
+        ))
+        return True
     async def process_referral_registration(self, referrer_user_id: str, new_user_id: str):
         """Обработать регистрацию нового пользователя по реферальной ссылке"""
         try:
@@ -454,20 +635,18 @@ class Storage:
 
     async def get_cached_setting(self, key: str) -> str:
         if key in self._settings_cache:
-            import logging
-            logging.info(f"Cache hit for key: {key} with value: {self._settings_cache[key]}")
+            cache_requests_total.inc("settings", "hit")
             return self._settings_cache[key]
             
+        cache_requests_total.inc("settings", "miss")
         setting = await self.get_setting(key)
         value = setting.value if setting else ""
-        import logging
-        logging.info(f"Cache miss for key: {key}, loading value: {value}")
+        logger.debug("Setting cache miss for key: %s", key)
         self._settings_cache[key] = value
         return value
     
     async def update_setting(self, key: str, value: str):
-        import logging
-        logging.info(f"Updating setting key: {key} with value: {value}")
+        logger.info("Updating setting key: %s with value: %s", key, value)
         # Найти или создать setting
         result = await self.db.execute(
             select(Setting).where(Setting.key == key)
@@ -485,5 +664,89 @@ class Storage:
         
         # Инвалидировать кэш
         if key in self._settings_cache:
-            logging.info(f"Invalidating cache for key: {key}")
+            logger.debug("Invalidating cache for key: %s", key)
             del self._settings_cache[key]
+
+    # Price history methods
+    async def add_price_history(self, rows: List[dict]):
+        """Записать пачку котировок одним INSERT"""
+        if not rows:
+            return
+        await self.db.execute(insert(PriceHistory), rows)
+        await self.db.commit()
+
+    async def get_price_history(self, since: Optional[datetime] = None, limit: Optional[int] = None) -> List[PriceHistory]:
+        """Котировки TON начиная с since, в хронологическом порядке"""
+        query = select(PriceHistory)
+        if since is not None:
+            query = query.where(PriceHistory.created_at >= since)
+        if limit is not None:
+            # Последние limit записей
+            query = query.order_by(PriceHistory.created_at.desc()).limit(limit)
+            result = await self.db.execute(query)
+            return list(reversed(result.scalars().all()))
+        result = await self.db.execute(query.order_by(PriceHistory.created_at))
+        return result.scalars().all()
+
+    async def add_payment_event(self, provider: str, intid: str, **fields) -> Optional[PaymentEvent]:
+        """Записать событие платежа; None, если (provider, intid) уже есть"""
+        event = PaymentEvent(provider=provider, intid=intid, **fields)
+        self.db.add(event)
+        try:
+            await self.db.commit()
+        except IntegrityError:
+            await self.db.rollback()
+            return None
+        await self.db.refresh(event)
+        return event
+
+    async def get_due_payment_events(self, now: datetime, limit: int = 50) -> List[PaymentEvent]:
+        """Необработанные события outbox, у которых подошло время попытки"""
+        result = await self.db.execute(
+            select(PaymentEvent)
+            .where(and_(
+                PaymentEvent.status == "pending",
+                or_(PaymentEvent.next_attempt_at.is_(None), PaymentEvent.next_attempt_at <= now)
+            ))
+            .order_by(PaymentEvent.id)
+            .limit(limit)
+        )
+        return result.scalars().all()
+
+    async def update_payment_event(self, event_id: int, updates: dict):
+        await self.db.execute(
+            update(PaymentEvent).where(PaymentEvent.id == event_id).values(**updates)
+        )
+        await self.db.commit()
+
+    async def get_payment_event_counts(self) -> dict:
+        """Количество событий outbox по статусам"""
+        result = await self.db.execute(
+            select(PaymentEvent.status, func.count(PaymentEvent.id)).group_by(PaymentEvent.status)
+        )
+        return {status: count for status, count in result.all()}
+
+    async def create_broadcast(self, data: dict) -> Broadcast:
+        broadcast = Broadcast(**data)
+        self.db.add(broadcast)
+        await self.db.commit()
+        await self.db.refresh(broadcast)
+        return broadcast
+
+    async def get_broadcast(self, broadcast_id: str) -> Optional[Broadcast]:
+        result = await self.db.execute(select(Broadcast).where(Broadcast.id == broadcast_id))
+        return result.scalar_one_or_none()
+
+    async def get_running_broadcasts(self) -> List[Broadcast]:
+        result = await self.db.execute(
+            select(Broadcast).where(Broadcast.status == "running").order_by(Broadcast.created_at)
+        )
+        return result.scalars().all()
+
+    async def update_broadcast(self, broadcast_id: str, updates: dict):
+        await self.db.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(updated_at=datetime.utcnow(), **updates)
+        )
+        await self.db.commit()
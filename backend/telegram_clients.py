@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pyrogram import Client
+from pyrogram.errors import AuthKeyUnregistered, FloodWait
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    """Одна пользовательская сессия Pyrogram в пуле"""
+
+    def __init__(self, name: str, session_string: str):
+        self.name = name
+        self.session_string = session_string
+        self.client: Optional[Client] = None
+        self.blocked_until = 0.0  # time.monotonic(), до которого действует FloodWait
+        self.last_used = 0.0
+        self.calls = 0
+        self.flood_waits = 0
+        self.alive = False
+
+    async def start(self):
+        self.client = Client(self.name, session_string=self.session_string)
+        await self.client.start()
+        self.alive = True
+
+    async def stop(self):
+        self.alive = False
+        if self.client is not None:
+            try:
+                await self.client.stop()
+            except Exception as e:
+                logger.warning(f"Error stopping telegram session {self.name}: {e}")
+            self.client = None
+
+
+class TelegramClientManager:
+    """Пул сессий Pyrogram с ленивым запуском и общим учетом FloodWait.
+
+    Сессии запускаются один раз под asyncio.Lock при первом обращении.
+    call() выполняет запрос на наименее загруженной свободной сессии; при
+    FloodWait сессия блокируется на указанное время, а запрос повторяется
+    на другой сессии или ждет ближайшую освободившуюся (не дольше
+    max_flood_wait). AuthKeyUnregistered — одна попытка переподключения,
+    затем сессия выводится из пула.
+    """
+
+    def __init__(self, session_strings: Optional[List[str]] = None, max_flood_wait: float = 60.0):
+        if session_strings is None:
+            session_strings = [
+                value.strip()
+                for value in (os.getenv("TELEGRAM_SESSION_STRINGS") or os.getenv("TELEGRAM_SESSION_STRING") or "").split(",")
+                if value.strip()
+            ]
+        self._sessions = [
+            _Session("my_account" if i == 0 else f"my_account_{i}", session_string)
+            for i, session_string in enumerate(session_strings)
+        ]
+        self.max_flood_wait = max_flood_wait
+        self._lock = asyncio.Lock()
+        self._started = False
+
+    async def _ensure_started(self):
+        if self._started:
+            return
+        async with self._lock:
+            if self._started:
+                return
+            if not self._sessions:
+                logger.error("No session string found")
+                return
+            for session in self._sessions:
+                try:
+                    await session.start()
+                    logger.info(f"Telegram session {session.name} started")
+                except Exception as e:
+                    logger.error(f"Failed to start telegram session {session.name}: {e}")
+            # Если не поднялась ни одна сессия, следующий вызов попробует снова
+            self._started = any(session.alive for session in self._sessions)
+
+    async def _acquire(self) -> _Session:
+        """Свободная сессия; если все под FloodWait — ждем ближайшую"""
+        alive = [session for session in self._sessions if session.alive]
+        if not alive:
+            raise RuntimeError("No telegram sessions available")
+
+        session = min(alive, key=lambda s: (s.blocked_until, s.last_used))
+        wait = session.blocked_until - time.monotonic()
+        if wait > self.max_flood_wait:
+            raise FloodWait(value=int(wait) + 1)
+        if wait > 0:
+            logger.info(f"⏳ All telegram sessions in FloodWait, waiting {wait:.0f}s")
+            await asyncio.sleep(wait)
+        session.last_used = time.monotonic()
+        session.calls += 1
+        return session
+
+    async def call(self, request: Callable[[Client], Awaitable[Any]], attempts: int = 3) -> Any:
+        """Выполнить request(client) с учетом FloodWait и переподключением сессий"""
+        await self._ensure_started()
+        if not self._started:
+            raise RuntimeError("Telegram client is not configured")
+
+        for attempt in range(1, attempts + 1):
+            session = await self._acquire()
+            try:
+                return await request(session.client)
+            except FloodWait as e:
+                session.flood_waits += 1
+                session.blocked_until = time.monotonic() + float(e.value or 0)
+                logger.warning(f"⚠️ FloodWait {e.value}s on telegram session {session.name}")
+                if attempt == attempts:
+                    raise
+            except AuthKeyUnregistered:
+                logger.error(f"❌ Telegram session {session.name} is unregistered, reconnecting")
+                await self._reconnect(session)
+                if attempt == attempts:
+                    raise
+
+    async def _reconnect(self, session: _Session):
+        async with self._lock:
+            await session.stop()
+            try:
+                await session.start()
+                logger.info(f"Telegram session {session.name} reconnected")
+            except Exception as e:
+                logger.error(f"Telegram session {session.name} removed from pool: {e}")
+
+    def stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        return {
+            session.name: {
+                "alive": session.alive,
+                "calls": session.calls,
+                "flood_waits": session.flood_waits,
+                "blocked_for_s": round(max(0.0, session.blocked_until - now), 1),
+            }
+            for session in self._sessions
+        }
+
+    async def stop(self):
+        async with self._lock:
+            for session in self._sessions:
+                await session.stop()
+            self._started = False
@@ -0,0 +1,58 @@
+import gc
+import os
+import tempfile
+
+import pytest
+
+# До импорта database: отдельная SQLite-база на прогон тестов
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.environ.setdefault("REFERRAL_CODE_SECRET", "test-referral-secret")
+
+from tests.stubs import TEST_COOKIES, TEST_SEED, FragmentStub, PriceStub  # noqa: E402
+
+
+@pytest.fixture
+async def db():
+    """Чистая схема на каждый тест"""
+    from database import engine, init_db
+    from models import Base
+
+    await init_db()
+    yield
+    # Соединения пула привязаны к event loop теста; закрываем и те, в которых
+    # остановленный воркер мог оставить незавершенную транзакцию. Соединение,
+    # брошенное отмененным посреди запроса воркером, пулу не возвращается и
+    # держит блокировку SQLite, пока его не соберет gc
+    gc.collect()
+    await engine.dispose()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+
+
+@pytest.fixture
+async def price_stub():
+    server = await PriceStub().start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def fragment_stub():
+    server = await FragmentStub().start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def fragment_client(fragment_stub):
+    from api import AsyncFragmentAPIClient, RetryPolicy
+
+    client = AsyncFragmentAPIClient(
+        seed=TEST_SEED,
+        fragment_cookies=TEST_COOKIES,
+        base_url=fragment_stub.url,
+        retry_policy=RetryPolicy(attempts=2, base_delay=0.01, max_delay=0.01),
+    )
+    yield client
+    await client.close()
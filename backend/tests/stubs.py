@@ -0,0 +1,121 @@
+"""Локальные stub-серверы внешних API для тестов"""
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from ton_price_service import PriceSource
+
+# Учетные данные Fragment, которые проходят валидацию клиента
+TEST_SEED = " ".join(["word"] * 24)
+TEST_COOKIES = "stel_ssid=test; stel_token=test"
+
+
+class StubServer:
+    """aiohttp-приложение на 127.0.0.1 со свободным портом"""
+
+    def __init__(self):
+        self.app = web.Application()
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> "StubServer":
+        # Зависшие (медленные) обработчики при остановке не дожидаемся
+        self._runner = web.AppRunner(self.app, shutdown_timeout=0.1)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class PriceStub(StubServer):
+    """Источники котировок: GET /<name> -> {"price": "..."}.
+
+    quote(name, price, delay, status) настраивает ответ источника,
+    requests считает обращения к каждому.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.quotes: Dict[str, dict] = {}
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.app.router.add_get("/{name}", self._quote)
+
+    def quote(self, name: str, price: float = 1.0, delay: float = 0.0, status: int = 200) -> PriceSource:
+        self.quotes[name] = {"price": price, "delay": delay, "status": status}
+        return PriceSource(name, f"{self.url}/{name}", lambda data: float(data["price"]))
+
+    async def _quote(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        self.requests[name] += 1
+        quote = self.quotes[name]
+        if quote["delay"]:
+            await asyncio.sleep(quote["delay"])
+        if quote["status"] != 200:
+            return web.json_response({"error": "stub failure"}, status=quote["status"])
+        return web.json_response({"price": str(quote["price"])})
+
+
+class FragmentStub(StubServer):
+    """Fragment API с заказами в памяти.
+
+    fail_buys — сколько следующих покупок ответят 500 без заказа,
+    lose_responses — сколько покупок создадут заказ, но вернут ошибку
+    (оплата прошла, ответ потерян: 502), buy_delay — задержка покупки.
+    """
+
+    def __init__(self, buy_delay: float = 0.0):
+        super().__init__()
+        self.buy_delay = buy_delay
+        self.fail_buys = 0
+        self.lose_responses = 0
+        self.orders: List[dict] = []  # Новые первыми, как в getOrders
+        self.buy_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        for path in ("/buyStars", "/buyStarsWithoutKYC"):
+            self.app.router.add_post(path, self._buy)
+        self.app.router.add_post("/getOrders", self._get_orders)
+        self.app.router.add_post("/getUserInfo", self._get_user_info)
+
+    async def _buy(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.buy_calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.buy_delay:
+                await asyncio.sleep(self.buy_delay)
+            if self.fail_buys:
+                self.fail_buys -= 1
+                return web.json_response({"ok": False, "error": "stub failure"}, status=500)
+
+            order = {
+                "id": len(self.orders) + 1,
+                "username": data["username"],
+                "amount": data["amount"],
+                "created_at": datetime.utcnow().isoformat(),
+            }
+            self.orders.insert(0, order)
+            if self.lose_responses:
+                self.lose_responses -= 1
+                return web.json_response({"ok": False, "error": "gateway timeout"}, status=502)
+            return web.json_response({"ok": True, "order_id": order["id"]})
+        finally:
+            self.in_flight -= 1
+
+    async def _get_orders(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        offset, limit = int(data.get("offset", 0)), int(data.get("limit", 10))
+        return web.json_response({"orders": self.orders[offset:offset + limit]})
+
+    async def _get_user_info(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return web.json_response({"success": True, "found": True, "username": data["username"], "name": data["username"]})
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from avatars import AvatarCache
+
+
+class SlowFragment:
+    """get_user_info с задержкой; считает обращения"""
+
+    def __init__(self, delay: float = 0.05, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def get_user_info(self, username: str):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"success": True, "found": True, "name": username.title(), "photo": ""}
+
+
+async def test_parallel_requests_share_one_fetch():
+    cache, fragment = AvatarCache(), SlowFragment()
+
+    results = await asyncio.gather(*(cache.get(fragment, "alice") for _ in range(5)))
+
+    assert {info.first_name for info in results} == {"Alice"}
+    assert fragment.calls == 1
+    assert cache.stats()["coalesced"] == 4
+    assert (await cache.get(fragment, "@Alice")).first_name == "Alice"
+    assert fragment.calls == 1
+
+
+async def test_cancelled_leader_does_not_cancel_followers():
+    cache, fragment = AvatarCache(), SlowFragment()
+
+    leader = asyncio.create_task(cache.get(fragment, "alice"))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(cache.get(fragment, "alice"))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert (await follower).first_name == "Alice"
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+    assert fragment.calls == 1
+    assert cache.get_cached("alice") is not None
+
+
+async def test_errors_reach_followers_and_are_not_cached():
+    cache, fragment = AvatarCache(), SlowFragment(error=RuntimeError("fragment down"))
+
+    results = await asyncio.gather(*(cache.get(fragment, "alice") for _ in range(3)), return_exceptions=True)
+
+    assert [str(result) for result in results] == ["fragment down"] * 3
+    assert fragment.calls == 1
+    assert cache.get_cached("alice") is None
@@ -0,0 +1,86 @@
+import base64
+import time
+
+import pytest
+
+from api import AsyncFragmentAPIClient, FragmentAPIError
+from tests.stubs import TEST_COOKIES, TEST_SEED
+
+
+def b64(value: str) -> str:
+    return base64.b64encode(value.encode("utf-8")).decode("utf-8")
+
+
+class CountingClient(AsyncFragmentAPIClient):
+    """Считает реальные кодирования seed и cookies"""
+
+    def __init__(self, *args, **kwargs):
+        self.encodes = 0
+        super().__init__(*args, **kwargs)
+
+    def _base64_encode(self, data: str) -> str:
+        self.encodes += 1
+        return super()._base64_encode(data)
+
+
+def test_default_credentials_encoded_once_in_constructor():
+    client = CountingClient(seed=TEST_SEED, fragment_cookies=TEST_COOKIES)
+    encodes = client.encodes
+
+    for _ in range(100):
+        fields = client._auth_fields(use_cookies=True)
+
+    assert fields == {"fragment_cookies": b64(TEST_COOKIES), "seed": b64(TEST_SEED)}
+    assert client._auth_fields() == {"seed": b64(TEST_SEED)}
+    assert client._auth_fields(use_seed=False, use_cookies=True) == {"fragment_cookies": b64(TEST_COOKIES)}
+    assert client.encodes == encodes == 2
+
+
+def test_explicit_credentials_are_memoized():
+    client = CountingClient(seed=TEST_SEED)
+    other_seed = " ".join(["other"] * 12)
+
+    first = client._auth_fields(seed=other_seed)
+    second = client._auth_fields(seed=other_seed)
+
+    assert first == second == {"seed": b64(other_seed)}
+    assert client.encodes == 2  # seed по умолчанию + other_seed один раз
+
+
+async def test_invalid_default_seed_fails_on_call():
+    client = AsyncFragmentAPIClient(seed="too short", base_url="http://127.0.0.1:9")
+    with pytest.raises(FragmentAPIError, match="12 or 24"):
+        await client.get_balance()
+
+
+async def test_request_body_uses_cached_fields(fragment_stub, fragment_client):
+    await fragment_client.buy_stars("alice", 50)
+    await fragment_client.buy_stars("bob", 60)
+
+    assert [(order["username"], order["amount"]) for order in fragment_stub.orders] == [("bob", 60), ("alice", 50)]
+
+
+@pytest.mark.benchmark
+def test_request_preparation_overhead():
+    """Подготовка полей авторизации: шаблон против кодирования на каждый вызов"""
+    client = AsyncFragmentAPIClient(seed=TEST_SEED, fragment_cookies=TEST_COOKIES)
+    iterations = 20000
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        {"username": "alice", "amount": 50, **client._auth_fields(use_cookies=True)}
+    cached = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        {
+            "username": "alice",
+            "amount": 50,
+            "fragment_cookies": client._encode_fragment_cookies(TEST_COOKIES),
+            "seed": client._encode_seed(TEST_SEED),
+        }
+    uncached = time.perf_counter() - started
+
+    print(f"\nauth fields: cached {cached / iterations * 1e6:.2f} us/call, "
+          f"encoded per call {uncached / iterations * 1e6:.2f} us/call")
+    assert cached < uncached
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import func, select
+
+from database import AsyncSessionLocal
+from fsm_storage import CachedStorage, SQLAlchemyStorage, create_fsm_storage
+from models import FSMState
+
+KEY = StorageKey(bot_id=1, chat_id=100, user_id=100)
+OTHER_KEY = StorageKey(bot_id=1, chat_id=200, user_id=200)
+
+
+class Purchase(StatesGroup):
+    amount = State()
+
+
+async def fsm_rows() -> int:
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(select(func.count()).select_from(FSMState))).scalar_one()
+
+
+@pytest.mark.usefixtures("db")
+async def test_sql_storage_roundtrip():
+    storage = SQLAlchemyStorage()
+
+    await storage.set_state(KEY, Purchase.amount)
+    await storage.set_data(KEY, {"amount": 100, "recipient": "алиса"})
+
+    assert await storage.get_state(KEY) == "Purchase:amount"
+    assert await storage.get_data(KEY) == {"amount": 100, "recipient": "алиса"}
+    assert await storage.get_state(OTHER_KEY) is None
+    assert await storage.get_data(OTHER_KEY) == {}
+    assert await fsm_rows() == 1
+
+
+@pytest.mark.usefixtures("db")
+async def test_sql_storage_deletes_finished_dialog():
+    storage = SQLAlchemyStorage()
+    await storage.set_state(KEY, Purchase.amount)
+    await storage.set_data(KEY, {"amount": 100})
+
+    await storage.set_state(KEY, None)
+    assert await fsm_rows() == 1  # данные еще есть
+    await storage.set_data(KEY, {})
+
+    assert await fsm_rows() == 0
+
+
+@pytest.mark.usefixtures("db")
+async def test_sql_storage_survives_new_instance():
+    await SQLAlchemyStorage().set_state(KEY, Purchase.amount)
+    assert await SQLAlchemyStorage().get_state(KEY) == "Purchase:amount"
+
+
+async def test_cache_serves_reads_from_memory():
+    backend = MemoryStorage()
+    storage = CachedStorage(backend, ttl=60)
+
+    await storage.set_state(KEY, Purchase.amount)
+    await storage.set_data(KEY, {"amount": 100})
+    for _ in range(5):
+        assert await storage.get_state(KEY) == "Purchase:amount"
+        assert await storage.get_data(KEY) == {"amount": 100}
+
+    assert (storage.hits, storage.misses) == (10, 0)
+    # Записи проходят в хранилище насквозь
+    assert await backend.get_state(KEY) == "Purchase:amount"
+
+
+async def test_cached_data_is_a_copy():
+    storage = CachedStorage(MemoryStorage(), ttl=60)
+    await storage.set_data(KEY, {"amount": 100})
+
+    data = await storage.get_data(KEY)
+    data["amount"] = 1
+
+    assert await storage.get_data(KEY) == {"amount": 100}
+
+
+@pytest.fixture
+async def redis_storage():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("redis")
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    server = fakeredis.FakeServer()
+    storages = []
+
+    def make() -> RedisStorage:
+        # Каждый экземпляр — отдельное подключение к одному серверу, как у двух процессов бота
+        storage = RedisStorage(
+            redis=fakeredis.FakeAsyncRedis(server=server),
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+        )
+        storages.append(storage)
+        return storage
+
+    yield make
+    for storage in storages:
+        await storage.close()
+
+
+async def test_redis_state_is_shared_between_bot_instances(redis_storage):
+    first = CachedStorage(redis_storage(), ttl=0.05)
+    second = CachedStorage(redis_storage(), ttl=0.05)
+
+    await first.set_state(KEY, Purchase.amount)
+    await first.set_data(KEY, {"amount": 100})
+
+    assert await second.get_state(KEY) == "Purchase:amount"
+    assert await second.get_data(KEY) == {"amount": 100}
+
+    # Чужая запись видна после истечения ttl кэша
+    await first.set_data(KEY, {"amount": 200})
+    await asyncio.sleep(0.1)
+    assert await second.get_data(KEY) == {"amount": 200}
+
+
+async def test_redis_storage_clears_state(redis_storage):
+    storage = redis_storage()
+    await storage.set_state(KEY, Purchase.amount)
+    await storage.set_state(KEY, None)
+    assert await storage.get_state(KEY) is None
+
+
+def test_factory_selects_backend(monkeypatch):
+    monkeypatch.setenv("FSM_STORAGE", "memory")
+    assert isinstance(create_fsm_storage(), MemoryStorage)
+
+    monkeypatch.setenv("FSM_STORAGE", "sql")
+    monkeypatch.setenv("FSM_CACHE_TTL", "5")
+    storage = create_fsm_storage()
+    assert isinstance(storage, CachedStorage)
+    assert isinstance(storage.storage, SQLAlchemyStorage)
+
+    monkeypatch.setenv("FSM_CACHE_TTL", "0")
+    assert isinstance(create_fsm_storage(), SQLAlchemyStorage)
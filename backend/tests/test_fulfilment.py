@@ -0,0 +1,216 @@
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from database import AsyncSessionLocal
+from fulfilment import FragmentFulfilment
+from payments import complete_purchase
+from schemas import TransactionCreate, UserCreate
+from storage import Storage
+
+pytestmark = pytest.mark.usefixtures("db")
+
+
+async def create_paid_order(username: str = "alice", amount: int = 100, paid: bool = True) -> str:
+    """Покупка звезд для username; paid — оплачена через общий путь complete_purchase"""
+    async with AsyncSessionLocal() as session:
+        storage = Storage(session)
+        user = await storage.create_user(UserCreate(telegram_id=str(uuid.uuid4().int >> 80)))
+        transaction = await storage.create_transaction(TransactionCreate(
+            user_id=user.id,
+            type="buy_stars",
+            currency="stars",
+            amount=Decimal(amount),
+            recipient_username=username,
+            payment_system="freekassa",
+            invoice_id=str(uuid.uuid4()),
+        ))
+        if paid:
+            assert await complete_purchase(storage, transaction, "{}")
+        return transaction.id
+
+
+async def get_transaction(transaction_id: str):
+    async with AsyncSessionLocal() as session:
+        return await Storage(session).get_transaction(transaction_id)
+
+
+async def wait_for_delivery(transaction_id: str, timeout: float = 10.0):
+    """Дождаться окончательного статуса доставки"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        transaction = await get_transaction(transaction_id)
+        if transaction.delivery_status in ("delivered", "failed"):
+            return transaction
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"delivery of {transaction_id} stuck in {transaction.delivery_status}")
+
+
+@pytest.fixture
+async def fulfilment(fragment_client):
+    queue = FragmentFulfilment(concurrency=3, poll_interval=0.05, base_backoff=0, max_attempts=3)
+    queue.start(fragment_client)
+    yield queue
+    await queue.stop()
+
+
+async def test_complete_purchase_credits_once():
+    transaction_id = await create_paid_order(amount=100, paid=False)
+
+    # Webhook и фоновая сверка одновременно видят транзакцию в pending
+    async def complete():
+        async with AsyncSessionLocal() as session:
+            storage = Storage(session)
+            return await complete_purchase(storage, await storage.get_transaction(transaction_id), "{}")
+
+    assert sorted(await asyncio.gather(complete(), complete())) == [False, True]
+
+    transaction = await get_transaction(transaction_id)
+    async with AsyncSessionLocal() as session:
+        user = await Storage(session).get_user(transaction.user_id)
+    assert transaction.status == "completed"
+    assert transaction.delivery_status == "pending"
+    assert user.stars_balance == 100
+    assert user.total_stars_earned == 100
+
+
+async def test_claim_is_exclusive():
+    transaction_id = await create_paid_order()
+
+    async def claim():
+        async with AsyncSessionLocal() as session:
+            return await Storage(session).claim_delivery(transaction_id)
+
+    assert sorted(await asyncio.gather(claim(), claim(), claim())) == [False, False, True]
+    transaction = await get_transaction(transaction_id)
+    assert transaction.delivery_status == "processing"
+    assert transaction.delivery_attempts == 1
+
+
+async def test_stale_processing_returns_to_queue():
+    transaction_id = await create_paid_order()
+    async with AsyncSessionLocal() as session:
+        storage = Storage(session)
+        assert await storage.claim_delivery(transaction_id)
+        assert await storage.reset_stale_deliveries() == 1
+    assert (await get_transaction(transaction_id)).delivery_status == "pending"
+
+
+async def test_delivers_paid_order(fragment_stub, fulfilment):
+    transaction_id = await create_paid_order("alice", 150)
+    fulfilment.notify()
+
+    transaction = await wait_for_delivery(transaction_id)
+
+    assert transaction.delivery_status == "delivered"
+    assert transaction.delivery_attempts == 1
+    assert transaction.delivered_at is not None
+    assert json.loads(transaction.delivery_data)["ok"] is True
+    assert transaction.fragment_order_id == str(fragment_stub.orders[0]["id"])
+    assert [(order["username"], order["amount"]) for order in fragment_stub.orders] == [("alice", 150)]
+
+
+async def test_failed_buy_is_retried(fragment_stub, fulfilment):
+    fragment_stub.fail_buys = 1
+    transaction_id = await create_paid_order()
+
+    transaction = await wait_for_delivery(transaction_id)
+
+    assert transaction.delivery_status == "delivered"
+    assert transaction.delivery_attempts == 2
+    assert transaction.delivery_error is None
+    assert fragment_stub.buy_calls == 2
+    assert len(fragment_stub.orders) == 1
+
+
+async def test_lost_response_is_reconciled_not_bought_twice(fragment_stub, fulfilment):
+    fragment_stub.lose_responses = 1
+    transaction_id = await create_paid_order("bob", 200)
+
+    transaction = await wait_for_delivery(transaction_id)
+
+    assert transaction.delivery_status == "delivered"
+    assert transaction.delivery_attempts == 2
+    assert json.loads(transaction.delivery_data)["reconciled"] is True
+    assert transaction.fragment_order_id == str(fragment_stub.orders[0]["id"])
+    assert fragment_stub.buy_calls == 1
+    assert len(fragment_stub.orders) == 1
+
+
+async def test_gives_up_after_max_attempts(fragment_stub, fulfilment):
+    fragment_stub.fail_buys = 100
+    transaction_id = await create_paid_order()
+
+    transaction = await wait_for_delivery(transaction_id)
+
+    assert transaction.delivery_status == "failed"
+    assert transaction.delivery_attempts == fulfilment.max_attempts
+    assert "500" in transaction.delivery_error
+    assert fragment_stub.buy_calls == fulfilment.max_attempts
+
+
+async def test_retry_waits_for_backoff(fragment_stub, fragment_client):
+    fragment_stub.fail_buys = 1
+    queue = FragmentFulfilment(concurrency=1, poll_interval=0.05, base_backoff=60)
+    transaction_id = await create_paid_order()
+    queue.start(fragment_client)
+    try:
+        while fragment_stub.buy_calls == 0:
+            await asyncio.sleep(0.02)
+        # Несколько циклов опроса очереди: повтор еще не наступил
+        await asyncio.sleep(0.3)
+    finally:
+        await queue.stop()
+
+    transaction = await get_transaction(transaction_id)
+    assert transaction.delivery_status == "pending"
+    assert transaction.delivery_attempts == 1
+    assert transaction.delivery_next_attempt_at > datetime.utcnow() + timedelta(seconds=50)
+    assert fragment_stub.buy_calls == 1
+
+
+async def test_identical_orders_do_not_share_fragment_order(fragment_stub, fulfilment):
+    # Две одинаковые покупки в одной пачке; первая покупка отвечает 500
+    fragment_stub.fail_buys = 1
+    first = await create_paid_order("carol", 100)
+    second = await create_paid_order("carol", 100)
+
+    transactions = [await wait_for_delivery(first), await wait_for_delivery(second)]
+
+    assert [t.delivery_status for t in transactions] == ["delivered", "delivered"]
+    assert len(fragment_stub.orders) == 2
+    assert {t.fragment_order_id for t in transactions} == {str(order["id"]) for order in fragment_stub.orders}
+
+
+@pytest.mark.benchmark
+async def test_throughput(fragment_stub, fragment_client):
+    """Доставка пачки заказов при задержке Fragment 20 мс и concurrency 10"""
+    orders, concurrency = 100, 10
+    fragment_stub.buy_delay = 0.02
+    for i in range(orders):
+        await create_paid_order(f"user{i}", 50 + i)
+
+    queue = FragmentFulfilment(concurrency=concurrency, poll_interval=0.05, batch_size=50)
+    started = time.perf_counter()
+    queue.start(fragment_client)
+    try:
+        while True:
+            async with AsyncSessionLocal() as session:
+                counts = await Storage(session).get_delivery_counts()
+            if counts.get("delivered", 0) == orders:
+                break
+            assert time.perf_counter() - started < 30, counts
+            await asyncio.sleep(0.01)
+    finally:
+        await queue.stop()
+    elapsed = time.perf_counter() - started
+
+    print(f"\nfulfilment: {orders} orders in {elapsed:.2f}s, {orders / elapsed:.0f} orders/s, "
+          f"max in flight {fragment_stub.max_in_flight}")
+    assert fragment_stub.buy_calls == orders
+    assert fragment_stub.max_in_flight <= concurrency
@@ -0,0 +1,108 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+import payments
+from database import AsyncSessionLocal
+from payments import PaymentReconciler, complete_purchase
+from schemas import TransactionCreate, UserCreate
+from storage import Storage
+
+pytestmark = pytest.mark.usefixtures("db")
+
+
+async def create_pending(amount: int = 100) -> str:
+    async with AsyncSessionLocal() as session:
+        storage = Storage(session)
+        user = await storage.create_user(UserCreate(telegram_id=str(uuid.uuid4().int >> 80)))
+        transaction = await storage.create_transaction(TransactionCreate(
+            user_id=user.id,
+            type="buy_stars",
+            currency="stars",
+            amount=Decimal(amount),
+            payment_system="freekassa",
+            invoice_id=str(uuid.uuid4()),
+        ))
+        return transaction.id
+
+
+async def get_transaction(transaction_id: str):
+    async with AsyncSessionLocal() as session:
+        return await Storage(session).get_transaction(transaction_id)
+
+
+class FakeFreeKassa:
+    """check_payment_status по заранее заданным статусам; on_check — хук на время запроса"""
+
+    api_key = "test"
+
+    def __init__(self, statuses: dict, on_check=None):
+        self.statuses = statuses
+        self.on_check = on_check
+        self.calls = []
+
+    async def check_payment_status(self, invoice_id: str):
+        self.calls.append(invoice_id)
+        if self.on_check:
+            await self.on_check(invoice_id)
+        status = self.statuses.get(invoice_id)
+        return {"status": status, "response": {}} if status else None
+
+
+async def invoice_ids(*transaction_ids) -> dict:
+    return {(await get_transaction(t)).invoice_id: t for t in transaction_ids}
+
+
+async def test_reconciler_survives_race_with_webhook(monkeypatch):
+    raced, paid, cancelled_by_webhook = [await create_pending() for _ in range(3)]
+    invoices = await invoice_ids(raced, paid, cancelled_by_webhook)
+
+    async def webhook(invoice_id):
+        # Webhook завершает транзакции через свою сессию, пока сверка ждет FreeKassa
+        transaction_id = invoices[invoice_id]
+        if transaction_id in (raced, cancelled_by_webhook):
+            async with AsyncSessionLocal() as session:
+                storage = Storage(session)
+                assert await complete_purchase(storage, await storage.get_transaction(transaction_id), "{}")
+
+    statuses = {invoice: "paid" for invoice in invoices}
+    statuses[next(i for i, t in invoices.items() if t == cancelled_by_webhook)] = "cancelled"
+    monkeypatch.setattr(payments, "get_freekassa", lambda: FakeFreeKassa(statuses, webhook))
+
+    result = await PaymentReconciler().reconcile_once()
+
+    assert result == {"checked": 3, "completed": 1, "cancelled": 0}
+    for transaction_id in (raced, paid, cancelled_by_webhook):
+        assert (await get_transaction(transaction_id)).status == "completed"
+    async with AsyncSessionLocal() as session:
+        user = await Storage(session).get_user((await get_transaction(raced)).user_id)
+    assert user.stars_balance == 100  # начислено один раз, webhook'ом
+
+
+async def test_reconciler_cancels_pending(monkeypatch):
+    transaction_id = await create_pending()
+    invoices = await invoice_ids(transaction_id)
+    monkeypatch.setattr(payments, "get_freekassa", lambda: FakeFreeKassa({i: "cancelled" for i in invoices}))
+
+    assert (await PaymentReconciler().reconcile_once())["cancelled"] == 1
+    assert (await get_transaction(transaction_id)).status == "cancelled"
+
+
+async def test_old_invoices_are_polled_less_often(monkeypatch):
+    fresh, old = await create_pending(), await create_pending()
+    async with AsyncSessionLocal() as session:
+        await Storage(session).update_transaction(old, {"created_at": datetime.utcnow() - timedelta(hours=1)})
+    invoices = await invoice_ids(fresh, old)
+    freekassa = FakeFreeKassa({i: "pending" for i in invoices})
+    monkeypatch.setattr(payments, "get_freekassa", lambda: freekassa)
+    reconciler = PaymentReconciler(interval=0.05)
+
+    assert (await reconciler.reconcile_once())["checked"] == 2
+    await asyncio.sleep(0.1)
+    # Свежий счет опрашивается каждый проход, часовой — не чаще раза в 6 минут
+    assert (await reconciler.reconcile_once())["checked"] == 1
+    assert [invoices[i] for i in freekassa.calls].count(old) == 1
+    assert [invoices[i] for i in freekassa.calls].count(fresh) == 2
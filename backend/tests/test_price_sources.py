@@ -0,0 +1,131 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from http_clients import HTTPClientRegistry
+from ton_price_service import TONPriceService
+
+
+@pytest.fixture
+async def make_service():
+    """Сервис с источниками stub-сервера и общим пулом HTTP-клиентов, как в приложении"""
+    http_clients = HTTPClientRegistry()
+
+    def make(ton_usd, usd_rub=(), source_timeout: float = 1.0, **kwargs) -> TONPriceService:
+        service = TONPriceService(ton_usd_sources=list(ton_usd), usd_rub_sources=list(usd_rub),
+                                  source_timeout=source_timeout, **kwargs)
+        service.http_clients = http_clients
+        return service
+
+    yield make
+    await http_clients.close()
+
+
+async def test_median_of_all_sources(price_stub, make_service):
+    service = make_service([
+        price_stub.quote("a", 5.0),
+        price_stub.quote("b", 5.5),
+        price_stub.quote("c", 50.0),
+    ])
+    assert await service._median_quote(service.ton_usd_sources) == 5.5
+
+
+async def test_even_number_of_sources_averages_middle(price_stub, make_service):
+    service = make_service([price_stub.quote("a", 5.0), price_stub.quote("b", 6.0)])
+    assert await service._median_quote(service.ton_usd_sources) == 5.5
+
+
+async def test_slow_source_is_cut_off_at_deadline(price_stub, make_service):
+    service = make_service([
+        price_stub.quote("a", 5.0),
+        price_stub.quote("b", 6.0),
+        price_stub.quote("slow", 100.0, delay=5.0),
+    ], source_timeout=0.3)
+
+    started = time.perf_counter()
+    price = await service._median_quote(service.ton_usd_sources)
+
+    assert price == 5.5
+    assert time.perf_counter() - started < 2.0
+    stats = service.get_source_stats()
+    assert stats["slow"]["timeouts"] == 1
+    assert stats["a"]["errors"] == 0
+    assert stats["a"]["avg_latency_ms"] is not None
+
+
+async def test_failed_source_is_excluded(price_stub, make_service):
+    service = make_service([
+        price_stub.quote("a", 5.0),
+        price_stub.quote("broken", 100.0, status=500),
+    ])
+    assert await service._median_quote(service.ton_usd_sources) == 5.0
+    stats = service.get_source_stats()
+    assert stats["broken"]["errors"] == 1
+    assert stats["broken"]["last_error"] == "HTTP 500"
+
+
+async def test_non_positive_price_is_rejected(price_stub, make_service):
+    service = make_service([price_stub.quote("a", 5.0), price_stub.quote("zero", 0.0)])
+    assert await service._median_quote(service.ton_usd_sources) == 5.0
+    assert service.get_source_stats()["zero"]["errors"] == 1
+
+
+async def test_no_responders_raises(price_stub, make_service):
+    service = make_service([price_stub.quote("a", status=503), price_stub.quote("b", status=500)])
+    with pytest.raises(Exception, match="No price source responded"):
+        await service._median_quote(service.ton_usd_sources)
+
+
+async def test_failed_pair_cancels_the_other(price_stub, make_service):
+    service = make_service(
+        [price_stub.quote("ton", status=500)],
+        [price_stub.quote("rub", 90.0, delay=5.0)],
+        source_timeout=5.0,
+    )
+
+    started = time.perf_counter()
+    with pytest.raises(Exception, match="No price source responded"):
+        await service._fetch_rates()
+
+    assert time.perf_counter() - started < 2.0
+    # Запрос второй пары отменен, а не оставлен висеть в фоне
+    assert service.get_source_stats()["rub"]["timeouts"] == 1
+
+
+async def test_update_applies_markup_and_records_history(price_stub, make_service):
+    service = make_service(
+        [price_stub.quote("a", 2.0), price_stub.quote("b", 2.0)],
+        [price_stub.quote("rub", 100.0)],
+    )
+
+    price = await service._update_price_from_api(markup=5.0, fallback=420.0)
+
+    assert price == pytest.approx(210.0)
+    assert service.last_price == pytest.approx(210.0)
+    assert [point[1] for point in service.history.since(0)] == [pytest.approx(210.0)]
+    assert len(service._pending_history) == 1
+
+
+async def test_update_keeps_fallback_when_sources_fail(price_stub, make_service):
+    service = make_service([price_stub.quote("a", status=500)], [price_stub.quote("rub", 100.0)])
+
+    await service._update_price_from_api(markup=5.0, fallback=420.0)
+
+    assert service.last_price == 420.0
+    assert service.last_update is None
+
+
+class FailingHistoryStorage:
+    async def add_price_history(self, batch):
+        raise RuntimeError("database is down")
+
+
+async def test_unsaved_history_is_capped(make_service):
+    service = make_service([], history_capacity=5)
+    for price in range(12):
+        service._record_quote(price, price)
+        await service.flush_history(FailingHistoryStorage())
+
+    assert [float(item["price"]) for item in service._pending_history] == [7.0, 8.0, 9.0, 10.0, 11.0]
+    assert all(isinstance(item["created_at"], datetime) for item in service._pending_history)
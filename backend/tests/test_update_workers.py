@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiogram import Bot, F
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, Update, User
+
+from update_workers import UpdateWorkerPool, WorkerPoolDispatcher
+
+
+class Purchase(StatesGroup):
+    amount = State()
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> Update:
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type="private"),
+        from_user=User(id=chat_id, is_bot=False, first_name="test"),
+        text=text,
+    ))
+
+
+@pytest.fixture
+async def dispatcher():
+    pool = UpdateWorkerPool(workers=4, queue_size=10)
+    dp = WorkerPoolDispatcher(storage=MemoryStorage(), update_workers=pool)
+    bot = Bot(token="42:TEST")
+    yield dp, bot
+    await pool.stop()
+    await bot.session.close()
+
+
+async def test_next_update_sees_state_set_by_previous(dispatcher):
+    dp, bot = dispatcher
+    seen = []
+
+    @dp.message(F.text == "buy")
+    async def buy(message: Message, state: FSMContext):
+        await asyncio.sleep(0.05)  # второе обновление чата уже в очереди
+        await state.set_state(Purchase.amount)
+        seen.append("buy")
+
+    @dp.message(Purchase.amount)
+    async def amount(message: Message, state: FSMContext):
+        seen.append(f"amount {message.text}")
+        await state.clear()
+
+    @dp.message()
+    async def fallback(message: Message):
+        seen.append(f"fallback {message.text}")
+
+    await dp.feed_update(bot, message_update(1, 100, "buy"))
+    await dp.feed_update(bot, message_update(2, 100, "150"))
+    await dp.update_workers.stop()
+
+    assert seen == ["buy", "amount 150"]
+
+
+async def test_chats_are_processed_in_parallel(dispatcher):
+    dp, bot = dispatcher
+    running, peak = 0, 0
+
+    @dp.message()
+    async def slow(message: Message):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+    for chat_id in range(1, 5):
+        await dp.feed_update(bot, message_update(chat_id, chat_id, "hi"))
+    await dp.update_workers.stop()
+
+    assert peak > 1
+    assert dp.update_workers.stats()["processed"] == 4
+
+
+async def test_handler_errors_reach_dispatcher_error_handlers(dispatcher):
+    dp, bot = dispatcher
+    errors = []
+
+    @dp.message()
+    async def broken(message: Message):
+        raise ValueError("boom")
+
+    @dp.errors()
+    async def on_error(event):
+        errors.append(str(event.exception))
+        return True
+
+    await dp.feed_update(bot, message_update(1, 100, "hi"))
+    await dp.update_workers.stop()
+
+    assert errors == ["boom"]
+    assert dp.update_workers.errors == 0
@@ -1,14 +1,161 @@
+import asyncio
 import httpx
 import logging
-from datetime import datetime, timedelta
-from typing import Optional
+import statistics
+import time
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 logger = logging.getLogger(__name__)
 
+
+@dataclass
+class PriceSource:
+    """Источник котировки: URL и функция, достающая цену из JSON ответа"""
+    name: str
+    url: str
+    extract: Callable[[dict], float]
+
+
+@dataclass
+class SourceStats:
+    """Статистика запросов к одному источнику"""
+    requests: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    total_latency_ms: float = 0.0
+    last_latency_ms: Optional[float] = None
+    last_error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        answered = self.requests - self.timeouts
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "avg_latency_ms": round(self.total_latency_ms / answered, 1) if answered else None,
+            "last_latency_ms": round(self.last_latency_ms, 1) if self.last_latency_ms is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+# TON/USD котировки с бирж
+DEFAULT_TON_USD_SOURCES = [
+    PriceSource(
+        "binance",
+        "https://api.binance.com/api/v3/ticker/price?symbol=TONUSDT",
+        lambda data: float(data["price"]),
+    ),
+    PriceSource(
+        "okx",
+        "https://www.okx.com/api/v5/market/ticker?instId=TON-USDT",
+        lambda data: float(data["data"][0]["last"]),
+    ),
+    PriceSource(
+        "bybit",
+        "https://api.bybit.com/v5/market/tickers?category=spot&symbol=TONUSDT",
+        lambda data: float(data["result"]["list"][0]["lastPrice"]),
+    ),
+]
+
+# USD/RUB курсы
+DEFAULT_USD_RUB_SOURCES = [
+    PriceSource(
+        "exchangerate-api",
+        "https://api.exchangerate-api.com/v4/latest/USD",
+        lambda data: float(data["rates"]["RUB"]),
+    ),
+    PriceSource(
+        "open-er-api",
+        "https://open.er-api.com/v6/latest/USD",
+        lambda data: float(data["rates"]["RUB"]),
+    ),
+    PriceSource(
+        "cbr-xml-daily",
+        "https://www.cbr-xml-daily.ru/daily_json.js",
+        lambda data: float(data["Valute"]["USD"]["Value"]),
+    ),
+]
+
+
+def _utc_timestamp(value: datetime) -> float:
+    """Unix timestamp для naive datetime в UTC (как datetime.utcnow())"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class PriceHistoryBuffer:
+    """Кольцевой буфер последних котировок фиксированного размера.
+
+    Время (unix timestamp) и цены хранятся в двух array('d'), без
+    отдельного объекта на каждую точку.
+    """
+
+    def __init__(self, capacity: int = 2880):
+        self.capacity = capacity
+        self._timestamps = array('d', [0.0]) * capacity
+        self._prices = array('d', [0.0]) * capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def is_full(self) -> bool:
+        return self._size == self.capacity
+
+    def append(self, timestamp: float, price: float):
+        end = (self._start + self._size) % self.capacity
+        self._timestamps[end] = timestamp
+        self._prices[end] = price
+        if self._size < self.capacity:
+            self._size += 1
+        else:
+            # Перезаписали самую старую точку
+            self._start = (self._start + 1) % self.capacity
+
+    def oldest_timestamp(self) -> Optional[float]:
+        return self._timestamps[self._start] if self._size else None
+
+    def since(self, timestamp: float) -> List[Tuple[float, float]]:
+        """Точки (timestamp, price) не старше timestamp, по возрастанию времени"""
+        points = []
+        for i in range(self._size):
+            idx = (self._start + i) % self.capacity
+            if self._timestamps[idx] >= timestamp:
+                points.append((self._timestamps[idx], self._prices[idx]))
+        return points
+
+
 class TONPriceService:
-    def __init__(self):
+    def __init__(
+        self,
+        ton_usd_sources: Optional[Sequence[PriceSource]] = None,
+        usd_rub_sources: Optional[Sequence[PriceSource]] = None,
+        source_timeout: float = 3.0,
+        history_capacity: int = 2880,
+        history_batch_size: int = 10,
+        history_flush_interval: timedelta = timedelta(minutes=5),
+    ):
         self.last_price: Optional[float] = None
         self.last_update: Optional[datetime] = None
+        self.ton_usd_sources: List[PriceSource] = list(ton_usd_sources or DEFAULT_TON_USD_SOURCES)
+        self.usd_rub_sources: List[PriceSource] = list(usd_rub_sources or DEFAULT_USD_RUB_SOURCES)
+        # Дедлайн на один источник: всё, что не ответило за это время, отменяется
+        self.source_timeout = source_timeout
+        self.source_stats: Dict[str, SourceStats] = {}
+        # История котировок: кольцевой буфер в памяти + пачки для записи в price_history
+        self.history = PriceHistoryBuffer(history_capacity)
+        self.history_batch_size = history_batch_size
+        self.history_flush_interval = history_flush_interval
+        self._pending_history: List[dict] = []
+        self._history_loaded = False
+        # Общий пул HTTP-клиентов, выставляется при старте приложения
+        self.http_clients = None
 
     async def get_current_ton_price_rub(self, storage) -> float:
         """Получить текущую цену TON в рублях с наценкой"""
@@ -36,6 +183,7 @@ class TONPriceService:
             if need_update:
                 logger.info("🔄 Обновляем курс TON...")
                 await self._update_price_from_api(markup, fallback)
+                await self._maybe_flush_history(storage)
             else:
                 logger.info(f"📊 Используем кэшированную цену TON: {self.last_price:.2f} RUB")
             
@@ -56,48 +204,183 @@ class TONPriceService:
         fallback = float(fallback_str) if fallback_str and fallback_str.strip() else 420.0
         
         await self._update_price_from_api(markup, fallback)
+        await self._maybe_flush_history(storage)
         return self.last_price
 
+    async def load_history(self, storage):
+        """Заполнить буфер последними котировками из price_history"""
+        rows = await storage.get_price_history(limit=self.history.capacity)
+        for row in rows:
+            self.history.append(_utc_timestamp(row.created_at), float(row.price))
+        self._history_loaded = True
+        logger.info(f"📚 Загружено {len(rows)} котировок TON в буфер истории")
+
+    async def get_history(self, storage, since: datetime) -> List[Tuple[datetime, float]]:
+        """История цены TON с момента since: из буфера, а если он не покрывает период — из БД"""
+        since_ts = _utc_timestamp(since)
+        oldest = self.history.oldest_timestamp()
+        covered = (
+            (oldest is not None and oldest <= since_ts) or
+            (self._history_loaded and not self.history.is_full)
+        )
+        if covered:
+            return [(datetime.utcfromtimestamp(ts), price) for ts, price in self.history.since(since_ts)]
+
+        rows = await storage.get_price_history(since=since)
+        points = [(row.created_at, float(row.price)) for row in rows]
+        # Котировки, которые еще не записаны в БД
+        points.extend(
+            (item["created_at"], float(item["price"]))
+            for item in self._pending_history
+            if item["created_at"] >= since
+        )
+        return points
+
+    async def flush_history(self, storage):
+        """Записать накопленные котировки в price_history"""
+        if not self._pending_history:
+            return
+        batch, self._pending_history = self._pending_history, []
+        try:
+            await storage.add_price_history(batch)
+            logger.info(f"💾 Записано {len(batch)} котировок TON в историю")
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи истории TON: {e}")
+            # Вернем пачку, чтобы записать со следующей; пока БД недоступна,
+            # храним не больше, чем вмещает кольцевой буфер
+            pending = batch + self._pending_history
+            dropped = len(pending) - self.history.capacity
+            if dropped > 0:
+                logger.warning(f"⚠️ Отброшено {dropped} старых котировок TON, не записанных в историю")
+                pending = pending[dropped:]
+            self._pending_history = pending
+
+    async def _maybe_flush_history(self, storage):
+        if not self._pending_history:
+            return
+        oldest = self._pending_history[0]["created_at"]
+        if (len(self._pending_history) >= self.history_batch_size or
+                datetime.utcnow() - oldest >= self.history_flush_interval):
+            await self.flush_history(storage)
+
+    def _record_quote(self, base_price: float, final_price: float):
+        now = datetime.utcnow()
+        self.history.append(_utc_timestamp(now), final_price)
+        self._pending_history.append({
+            "price": Decimal(f"{final_price:.2f}"),
+            "base_price": Decimal(f"{base_price:.2f}"),
+            "created_at": now,
+        })
+
+    def get_source_stats(self) -> Dict[str, Dict]:
+        """Статистика задержек и ошибок по источникам"""
+        return {name: stats.to_dict() for name, stats in self.source_stats.items()}
+
+    async def _fetch_source(self, source: PriceSource, client: Optional[httpx.AsyncClient] = None) -> float:
+        """Запросить один источник и учесть задержку/ошибку"""
+        if client is None:
+            client = self.http_clients.get_client(source.url)
+        stats = self.source_stats.setdefault(source.name, SourceStats())
+        stats.requests += 1
+        started = time.perf_counter()
+        try:
+            response = await client.get(source.url, timeout=self.source_timeout)
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}")
+            price = source.extract(response.json())
+            if price <= 0:
+                raise Exception(f"non-positive price {price}")
+        except (asyncio.CancelledError, httpx.TimeoutException):
+            # Отменён по дедлайну — латентность не учитываем
+            stats.timeouts += 1
+            stats.errors += 1
+            stats.last_error = "timeout"
+            raise
+        except Exception as e:
+            stats.errors += 1
+            stats.last_error = str(e) or type(e).__name__
+            self._record_latency(stats, started)
+            raise
+        self._record_latency(stats, started)
+        return price
+
+    @staticmethod
+    def _record_latency(stats: SourceStats, started: float):
+        stats.last_latency_ms = (time.perf_counter() - started) * 1000
+        stats.total_latency_ms += stats.last_latency_ms
+
+    async def _median_quote(self, sources: Sequence[PriceSource], client: Optional[httpx.AsyncClient] = None) -> float:
+        """Опросить источники параллельно и взять медиану ответивших за дедлайн"""
+        tasks = {
+            asyncio.create_task(self._fetch_source(source, client)): source
+            for source in sources
+        }
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.source_timeout)
+        finally:
+            # Отменяем отстающих (или всех, если отменен сам опрос), их ответы уже не нужны
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+
+        if pending:
+            logger.warning(f"⏱ Источники не уложились в {self.source_timeout}s: "
+                           f"{', '.join(tasks[t].name for t in pending)}")
+
+        quotes = {}
+        for task in done:
+            source = tasks[task]
+            if task.exception() is not None:
+                logger.warning(f"⚠️ Источник {source.name} недоступен: {task.exception()}")
+                continue
+            quotes[source.name] = task.result()
+
+        if not quotes:
+            raise Exception(f"No price source responded: {', '.join(s.name for s in sources)}")
+
+        logger.info(f"📡 Котировки: {quotes}")
+        return statistics.median(quotes.values())
+
+    async def _fetch_rates(self, client: Optional[httpx.AsyncClient] = None) -> Tuple[float, float]:
+        """TON/USD и USD/RUB — обе пары запрашиваем одновременно"""
+        tasks = [
+            asyncio.create_task(self._median_quote(self.ton_usd_sources, client)),
+            asyncio.create_task(self._median_quote(self.usd_rub_sources, client)),
+        ]
+        try:
+            ton_usd, usd_rub = await asyncio.gather(*tasks)
+        finally:
+            # gather не отменяет вторую пару, если первая упала
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return ton_usd, usd_rub
+
     async def _update_price_from_api(self, markup: float, fallback: float):
         """Обновить цену с внешних API"""
         try:
-            async with httpx.AsyncClient() as client:
-                # Получаем курс TON/USD с Binance
-                logger.info("📡 Запрос курса TON/USD...")
-                ton_response = await client.get(
-                    "https://api.binance.com/api/v3/ticker/price?symbol=TONUSDT", 
-                    timeout=10
-                )
-                
-                if ton_response.status_code != 200:
-                    raise Exception(f"Binance API error: {ton_response.status_code}")
-                    
-                ton_usd = float(ton_response.json()["price"])
-                logger.info(f"📈 TON/USD: ${ton_usd}")
-                
-                # Получаем курс USD/RUB
-                logger.info("📡 Запрос курса USD/RUB...")
-                usd_response = await client.get(
-                    "https://api.exchangerate-api.com/v4/latest/USD", 
-                    timeout=10
-                )
-                
-                if usd_response.status_code != 200:
-                    raise Exception(f"Exchange rate API error: {usd_response.status_code}")
-                    
-                usd_rub = usd_response.json()["rates"]["RUB"]
-                logger.info(f"💱 USD/RUB: {usd_rub}")
-                
-                # Считаем цену с наценкой
-                base_price = ton_usd * usd_rub
-                final_price = base_price * (1 + markup / 100)
-                
-                self.last_price = final_price
-                self.last_update = datetime.utcnow()
-                
-                logger.info(f"✅ TON цена обновлена: {base_price:.2f} RUB + {markup}% = {final_price:.2f} RUB")
-                return final_price
-                
+            if self.http_clients is not None:
+                ton_usd, usd_rub = await self._fetch_rates()
+            else:
+                # Без общего пула — временный клиент на один раунд
+                async with httpx.AsyncClient() as client:
+                    ton_usd, usd_rub = await self._fetch_rates(client)
+            logger.info(f"📈 TON/USD: ${ton_usd}")
+            logger.info(f"💱 USD/RUB: {usd_rub}")
+
+            # Считаем цену с наценкой
+            base_price = ton_usd * usd_rub
+            final_price = base_price * (1 + markup / 100)
+
+            self.last_price = final_price
+            self.last_update = datetime.utcnow()
+            self._record_quote(base_price, final_price)
+
+            logger.info(f"✅ TON цена обновлена: {base_price:.2f} RUB + {markup}% = {final_price:.2f} RUB")
+            return final_price
+
         except Exception as e:
             logger.error(f"❌ Ошибка обновления курса TON: {e}")
             # В случае ошибки используем fallback, но не обновляем кэш
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateWorkerPool:
+    """Пул обработчиков обновлений бота с порядком внутри чата.
+
+    Обновление кладется в очередь воркера, выбранного по chat_id, еще до
+    диспетчера; воркер передает его в Dispatcher.feed_update целиком.
+    Поэтому FSM-состояние читается и блокировка чата берется уже в
+    воркере, после обработки предыдущих обновлений этого чата. Один чат
+    всегда попадает к одному воркеру, сообщения одного пользователя
+    обрабатываются по порядку, а разные чаты — параллельно, не более
+    workers одновременно. Очереди ограничены queue_size: при переполнении
+    прием обновлений ждет (polling не тянет новые, webhook отвечает позже).
+    """
+
+    def __init__(self, workers: int = 16, queue_size: int = 1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.errors = 0
+        self.total_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.total_wait_ms = 0.0
+
+    def _ensure_started(self):
+        if not self._tasks:
+            self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+            logger.info(f"🧵 Bot update workers started ({self.workers})")
+
+    async def put(self, update: Update, process: Callable[[], Awaitable[Any]]):
+        """Поставить обработку обновления в очередь воркера его чата"""
+        self._ensure_started()
+        context = UserContextMiddleware.resolve_event_context(update)
+        key = context.chat_id or context.user_id or update.update_id
+        await self._queues[hash(key) % self.workers].put((update, process, time.monotonic()))
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update, process, enqueued_at = await queue.get()
+            started = time.monotonic()
+            self.total_wait_ms += (started - enqueued_at) * 1000
+            try:
+                await process()
+            except Exception as e:
+                # Сюда доходят ошибки, не обработанные dp.errors()
+                self.errors += 1
+                logger.error(f"❌ Error handling update {update.update_id}: {e}", exc_info=True)
+            finally:
+                latency_ms = (time.monotonic() - started) * 1000
+                self.processed += 1
+                self.total_latency_ms += latency_ms
+                self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+                queue.task_done()
+
+    def stats(self) -> Dict:
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "workers": self.workers,
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "processed": self.processed,
+            "errors": self.errors,
+            "avg_latency_ms": round(self.total_latency_ms / self.processed, 1) if self.processed else None,
+            "max_latency_ms": round(self.max_latency_ms, 1),
+            "avg_wait_ms": round(self.total_wait_ms / self.processed, 1) if self.processed else None,
+        }
+
+    async def stop(self, timeout: Optional[float] = 10.0):
+        """Дообработать очереди (не дольше timeout) и остановить воркеры"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ {sum(queue.qsize() for queue in self._queues)} bot updates dropped on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+
+
+class WorkerPoolDispatcher(Dispatcher):
+    """Dispatcher, который обрабатывает обновления пулом update_workers.
+
+    feed_update только ставит обновление в очередь; и polling, и webhook
+    проходят через него, а весь конвейер aiogram (ErrorsMiddleware,
+    контекст пользователя, FSM) выполняется в воркере.
+    """
+
+    def __init__(self, *args: Any, update_workers: UpdateWorkerPool, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.update_workers = update_workers
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        await self.update_workers.put(update, partial(super().feed_update, bot, update, **kwargs))
@@ -144,73 +144,93 @@ export default function BuyTab({ user, onShowLoading, onHideLoading }: BuyTabPro
     },
   });
 
-  // Poll payment status
-  const pollPaymentStatus = async (transactionId: string) => {
+  // Subscribe to payment status (server-sent events)
+  const pollPaymentStatus = (transactionId: string) => {
     setIsProcessing(true);
     onShowLoading('Ожидаем оплату...');
 
-    const maxAttempts = 60; // Увеличиваем до 10 минут
     const timeout = 10 * 60 * 1000; // 10 минут максимум
-    const startTime = Date.now();
-    let attempts = 0;
+    const initData = (window as any).Telegram?.WebApp?.initData || '';
+    const source = new EventSource(
+      `/api/payment/stream/${transactionId}?init_data=${encodeURIComponent(initData)}`
+    );
+
+    let finished = false;
+    const finish = () => {
+      finished = true;
+      clearTimeout(timer);
+      source.close();
+      onHideLoading();
+      setIsProcessing(false);
+    };
+
+    const timer = setTimeout(() => {
+      finish();
+      toast({
+        title: "Время ожидания истекло",
+        description: "Проверьте статус платежа позже",
+        variant: "destructive",
+      });
+    }, timeout);
+
+    // true — статус окончательный, ожидание завершено
+    const handleStatus = (statusData: { status?: string }) => {
+      if (statusData.status === 'completed') {
+        finish();
+        queryClient.invalidateQueries({ queryKey: ['/api/users/me'] });
+        setAmount('');
+
+        hapticFeedback('success');
+        toast({
+          title: "Оплата успешна!", 
+          description: `${selectedCurrency === 'stars' ? 'Звезды' : 'TON'} добавлены на ваш счет`,
+        });
+        return true;
+      }
+
+      if (statusData.status === 'failed' || statusData.status === 'cancelled') {
+        finish();
+        hapticFeedback('error');
+        toast({
+          title: "Оплата отменена",
+          description: "Платеж был отменен или не удался",
+          variant: "destructive",
+        });
+        return true;
+      }
+      return false;
+    };
 
-    const checkStatus = async () => {
+    source.onmessage = (event) => {
+      let statusData: { status?: string };
+      try {
+        statusData = JSON.parse(event.data);
+      } catch (error) {
+        console.error('Error parsing payment status:', error);
+        return;
+      }
+      handleStatus(statusData);
+    };
+
+    // После обрыва EventSource переподключается сам; CLOSED — сервер отказал
+    // (например, 4xx), повторов не будет: проверяем статус один раз обычным запросом
+    source.onerror = async (error) => {
+      console.error('Payment status stream error:', error);
+      if (finished || source.readyState !== EventSource.CLOSED) return;
 
+      finish();
       try {
         const response = await apiRequest('GET', `/api/payment/status/${transactionId}`);
-        const statusData = await response.json();
-
-        if (statusData.status === 'completed') {
-          queryClient.invalidateQueries({ queryKey: ['/api/users/me'] });
-          setAmount('');
-          onHideLoading();
-          setIsProcessing(false);
-
-          hapticFeedback('success');
-          toast({
-            title: "Оплата успешна!", 
-            description: `${selectedCurrency === 'stars' ? 'Звезды' : 'TON'} добавлены на ваш счет`,
-          });
-          return;
-        }
-
-        if (statusData.status === 'failed' || statusData.status === 'cancelled') {
-          onHideLoading();
-          setIsProcessing(false);
-          hapticFeedback('error');
-          toast({
-            title: "Оплата отменена",
-            description: "Платеж был отменен или не удался",
-            variant: "destructive",
-          });
-          return;
-        }
-
-        attempts++;
-        if (attempts < maxAttempts) {
-          setTimeout(checkStatus, 10000);
-        } else {
-          onHideLoading();
-          setIsProcessing(false);
-          toast({
-            title: "Время ожидания истекло",
-            description: "Проверьте статус платежа позже",
-            variant: "destructive",
-          });
-        }
+        if (handleStatus(await response.json())) return;
       } catch (error) {
         console.error('Error checking payment status:', error);
-        attempts++;
-        if (attempts < maxAttempts) {
-          setTimeout(checkStatus, 10000);
-        } else {
-          onHideLoading();
-          setIsProcessing(false);
-        }
       }
+      toast({
+        title: "Статус платежа неизвестен",
+        description: "Проверьте статус платежа позже",
+        variant: "destructive",
+      });
     };
-
-    setTimeout(checkStatus, 5000);
   };
 
   const handleCurrencySelect = (currency: Currency) => {